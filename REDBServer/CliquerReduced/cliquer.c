@@ -9,6 +9,7 @@
 #include <stdio.h>
 #include <stdlib.h>
 #include <limits.h>
+#include <time.h>
 //#include <unistd.h>
 
 #include "cliquer.h"
@@ -39,6 +40,13 @@ static int weight_multiplier=1;  /* Weights multiplied by this when passing
 static int **temp_list=NULL;
 static int temp_count=0;
 
+/* Search budget (see get_max_clique_bounded_redb). */
+#define SEARCH_CLOCK_CHECK_INTERVAL 1024
+static long search_node_limit=0;  /* Max. recursion nodes, 0 = unlimited */
+static clock_t search_deadline=0; /* Deadline in clock() ticks, 0 = none */
+static long search_nodes=0;       /* Recursion nodes visited so far */
+static boolean search_aborted=FALSE;
+
 
 /*
  * Macros for re-entrance.  ENTRANCE_SAVE() must be called immediately
@@ -98,8 +106,21 @@ extern void free_redb(void* p){
 }
 
 int* get_max_clique_redb(graph_t *g, clique_options *opts){
-	
+	return get_max_clique_bounded_redb(g,opts,0,0,NULL);
+}
 
+/*
+ * get_max_clique_bounded_redb()
+ *
+ * Like get_max_clique_redb(), but stops searching after visiting
+ * node_limit recursion nodes or after time_limit seconds of processor
+ * time (0 means no limit), returning the heaviest clique found so far.
+ * *optimal (if optimal is non-NULL) is set to 1 if the search completed,
+ * i.e. the clique is a maximum-weight clique, and to 0 otherwise.
+ */
+int* get_max_clique_bounded_redb(graph_t *g, clique_options *opts,
+				 long node_limit, double time_limit,
+				 int *optimal){
 	set_t s;
 	int setSize;
 	int* clique;
@@ -108,9 +129,26 @@ int* get_max_clique_redb(graph_t *g, clique_options *opts){
 	ASSERT((sizeof(setelement)*8)==ELEMENTSIZE);
 	ASSERT(g!=NULL);
 
+	search_node_limit=node_limit;
+	search_deadline=0;
+	if (time_limit > 0)
+		search_deadline=clock() + (clock_t)(time_limit * CLOCKS_PER_SEC) + 1;
+	search_nodes=0;
+	search_aborted=FALSE;
+
 	s=clique_find_single(g,0,0,FALSE,opts);
+
+	search_node_limit=0;
+	search_deadline=0;
+	if (optimal)
+		*optimal=!search_aborted;
 	if (s==NULL) {
-		/* Search was aborted. */
+		if (search_aborted) {
+			/* Aborted before a clique of positive weight was
+			 * found. */
+			clique = (int*)calloc(1, sizeof(int));
+			return clique;
+		}
 		return NULL;
 	}
 	
@@ -387,6 +425,19 @@ static int sub_weighted_all(int *table, int size, int weight,
 	int *p1, *p2;
 	int newweight;
 
+	if (search_node_limit || search_deadline) {
+		search_nodes++;
+		if ((search_node_limit && (search_nodes > search_node_limit)) ||
+		    (search_deadline &&
+		     (search_nodes % SEARCH_CLOCK_CHECK_INTERVAL == 0) &&
+		     (clock() > search_deadline))) {
+			/* Out of budget. best_clique holds the heaviest
+			 * clique found so far. */
+			search_aborted=TRUE;
+			return -1;
+		}
+	}
+
 	if (current_weight >= min_weight) {
 		if ((current_weight <= max_weight) &&
 		    ((!maximal) || is_maximal(current_clique,g))) {
@@ -31,6 +31,9 @@ extern set_t clique_find_single(graph_t *g,int min_weight,int max_weight,
 
 extern clique_options * clique_options_new_redb(int *(*reorder_function)(graph_t *, boolean));
 int* get_max_clique_redb(graph_t *g, clique_options *opts);
+int* get_max_clique_bounded_redb(graph_t *g, clique_options *opts,
+				 long node_limit, double time_limit,
+				 int *optimal);
 
 extern void free_redb(void* p);
 
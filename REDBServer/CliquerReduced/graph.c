@@ -24,6 +24,29 @@ int graph_add_edge_redb(graph_t * g, int i, int j)
 	return -1;
 }
 
+/*
+ * graph_add_edges_redb()
+ *
+ * Adds num_of_edges edges, given as consecutive (i,j) pairs in edges.
+ * Returns 0 on success, or -1 if an edge is out of range (the edges before
+ * it are added).
+ */
+int graph_add_edges_redb(graph_t * g, int * edges, int num_of_edges)
+{
+	int k, i, j;
+	if (NULL==g)
+		return -1;
+	for (k=0; k<num_of_edges; k++)
+	{
+		i=edges[2*k];
+		j=edges[2*k+1];
+		if ((i<0) || (j<0) || (i>=g->n) || (j>=g->n))
+			return -1;
+		GRAPH_ADD_EDGE(g,i,j);
+	}
+	return 0;
+}
+
 int graph_set_vertex_weight_redb(graph_t * g, int i, int w)
 {
 	int n = g->n;
@@ -35,6 +58,27 @@ int graph_set_vertex_weight_redb(graph_t * g, int i, int w)
 	return -1;
 }
 
+/*
+ * graph_set_vertex_weights_redb()
+ *
+ * Sets the weights of all the g->n vertices. Returns 0 on success, or -1
+ * (setting no weight) if a weight is negative.
+ */
+int graph_set_vertex_weights_redb(graph_t * g, int * weights)
+{
+	int i;
+	if (NULL==g)
+		return -1;
+	for (i=0; i<g->n; i++)
+	{
+		if (weights[i]<0)
+			return -1;
+	}
+	for (i=0; i<g->n; i++)
+		g->weights[i]=weights[i];
+	return 0;
+}
+
 /*
  * graph_new()
  *
@@ -27,6 +27,8 @@ struct _graph_t {
 
 extern int graph_add_edge_redb(graph_t * g, int i, int j);
 extern int graph_set_vertex_weight_redb(graph_t * g, int i, int w);
+extern int graph_add_edges_redb(graph_t * g, int * edges, int num_of_edges);
+extern int graph_set_vertex_weights_redb(graph_t * g, int * weights);
 
 
 extern graph_t *graph_new(int n);
@@ -1,15 +1,34 @@
 # Python
-from collections import Counter
-from multiprocessing import Pool
+import heapq
+from multiprocessing import Pool, cpu_count
 import json
+import logging
+import threading
+import time
+
+# related third party imports
+import numpy as np
+
+# Django
+from django.db import connection, transaction
 
 # REDB
 import utils
-from models import Function, Description
-from heuristics import DictionarySimilarity, GraphSimilarity, FrameSimilarity
+import cache
+import indexes
+import minhash
+from models import Function, Description, Graph
+from models import bulk_save_functions, bulk_save_descriptions
+from models import get_descriptions_version
+from models import string_clusters, call_clusters
+from heuristics import (GraphSimilarity, FrameSimilarity,
+                        dictionary_similarities, graph_similarity_upper_bound)
 import constants
 import math
 
+logger = logging.getLogger(__name__)
+
+LSH_RETRIEVAL = "lsh"
 
 class Query:
     def __init__(self, request):
@@ -23,7 +42,8 @@ class Query:
 
         query_type = json.loads(query_dict['type'])
 
-        if not query_type in ["request", "submit"]:
+        if not query_type in ["request", "submit", "batch_request",
+                              "batch_submit", "cache_stats"]:
             raise Exception("Unknown query type.")
 
         return query_type
@@ -67,39 +87,231 @@ class SubmitAction:
         description.save()
 
 
-class RequestAction:
+class BatchSubmitAction:
+    """
+    Handles many submitted (attributes, description) pairs, ingesting them
+    in a single transaction with bulk queries.
+    """
     def __init__(self, request):
+        query_dict = request.POST
+        if not 'submissions' in query_dict:
+            raise Exception("batch_submit is missing submissions.")
+
+        submissions = json.loads(query_dict["submissions"],
+                                 object_hook=utils._decode_dict)
+        if not isinstance(submissions, list):
+            raise Exception("batch_submit submissions must be a list.")
+        if len(submissions) > constants.batch.MAX_BATCH_SIZE:
+            raise Exception("Too many functions in batch_submit.")
+        for submission in submissions:
+            if not (isinstance(submission, list) and len(submission) == 2):
+                raise Exception("A submission must be an " +
+                                "[attributes, description] pair.")
+
+        self.submissions = submissions
         self.user = request.user
 
-        query_dict = request.POST
-        if not 'attributes' in query_dict:
-            raise Exception("request is missing attributes.")
+    def process_attributes(self):
+        """
+        Returns the number of submissions left after dropping thunks.
+        """
+        processed_submissions = []
+        for (attributes, description) in self.submissions:
+            attributes = general_process_attributes(attributes)
+            if attributes["num_of_insns"] > 1:
+                processed_submissions.append((attributes, description))
+        self.submissions = processed_submissions
+        return len(self.submissions)
+
+    def temp_functions(self):
+        self.functions = [generate_function(attributes)
+                          for (attributes, _) in self.submissions]
+
+    def process_descriptions(self):
+        self.descriptions_data = [json.dumps(description, ensure_ascii=False)
+                                  for (_, description) in self.submissions]
+
+    def insert_descriptions(self):
+        try:
+            with transaction.commit_on_success():
+                functions = bulk_save_functions(self.functions)
+                descriptions = []
+                for (function, description_data) in \
+                        zip(functions, self.descriptions_data):
+                    description = Description()
+                    description.initialize(function, description_data,
+                                           self.user)
+                    descriptions.append(description)
+                bulk_save_descriptions(descriptions)
+        except:
+            # The ids of rows created by the rolled back transaction must
+            # not be reused, and their values must leave the clusters.
+            cache.string_id_cache.clear()
+            cache.call_id_cache.clear()
+            string_clusters.reset()
+            call_clusters.reset()
+            raise
 
-        self.attributes = json.loads(query_dict["attributes"],
-                                     encoding='ISO-8859-1',
-                                     object_hook=utils._decode_dict)
+
+class RequestAction:
+    def __init__(self, request, attributes=None, top_k=None):
+        """
+        attributes and top_k are taken from the request, unless they are
+        supplied (e.g. by a BatchRequestAction).
+        """
+        self.user = request.user
+        if top_k is None:
+            top_k = RequestAction.get_top_k(request.POST)
+        self.top_k = top_k
+
+        if attributes is None:
+            query_dict = request.POST
+            if not 'attributes' in query_dict:
+                raise Exception("request is missing attributes.")
+
+            attributes = json.loads(query_dict["attributes"],
+                                    encoding='ISO-8859-1',
+                                    object_hook=utils._decode_dict)
+        self.attributes = attributes
 
         if not (set(self.attributes.keys()) ==
                 set(constants.REQUIRED_ATTRIBUTES)):
             raise Exception("Missing attribute(s) / Too many attributes.")
 
+        self.exact_match = None
+        self.matching_funcs = []
+        self.descriptions_version = None
+        self.scoring_task_prefix = None
+        self.cascade_stats = CascadeStats()
+
+    @classmethod
+    def get_top_k(cls, query_dict):
+        """
+        Returns the number of best matching functions the request asks for,
+        or 0 for all of them.
+        """
+        if not 'top_k' in query_dict:
+            return constants.top_k.DEFAULT_K
+        top_k = json.loads(query_dict['top_k'])
+        if (not isinstance(top_k, (int, long)) or
+                not 0 <= top_k <= constants.top_k.MAX_K):
+            raise Exception("Invalid top_k.")
+        return top_k
+
     def process_attributes(self):
         self.attributes = general_process_attributes(self.attributes)
 
     def temp_function(self):
         self.function = generate_function(self.attributes)
 
+    def cached_descriptions(self, descriptions_version=None):
+        """
+        descriptions_version is the current version of the descriptions (see
+        models.DescriptionsVersion), which is queried if it isn't given.
+        """
+        if descriptions_version is None:
+            descriptions_version = get_descriptions_version()
+        # Taken before reading the descriptions, so that a cached response
+        # never has a newer version than its data.
+        self.descriptions_version = descriptions_version
+        return cache.response_cache.\
+            get_descriptions(self.attributes["func_signature"], self.top_k,
+                             descriptions_version)
+
+    def cache_descriptions(self, descriptions):
+        func_ids = [func.id for (func, _) in self.matching_funcs]
+        cache.response_cache.\
+            put_descriptions(self.attributes["func_signature"], func_ids,
+                             descriptions, self.top_k,
+                             self.descriptions_version)
+
+    def exact_match_filtering(self):
+        """
+        A stored function with the requested function's signature is
+        identical to it, so it matches without any scoring.
+        """
+        try:
+            exact_match = Function.objects.\
+                get(signature=self.attributes["func_signature"])
+        except Function.DoesNotExist:
+            return
+        self.set_exact_match(exact_match)
+
+    def set_exact_match(self, exact_match):
+        self.exact_match = exact_match
+        self.matching_funcs.append((exact_match, 1.0))
+
+    def fuzzy_matching_required(self):
+        return not (self.exact_match and
+                    constants.exact_match.SKIP_FUZZY_MATCHING)
+
     def db_filtering(self):
-        func = self.function
-        func_set = Function.objects
-        func_set = RequestAction.insns_num_filter(func, func_set)
-        func_set = RequestAction.blocks_num_filter(func, func_set)
-        func_set = RequestAction.edges_num_filter(func, func_set)
-        func_set = RequestAction.calls_num_filter(func, func_set)
-        func_set = RequestAction.strings_num_filter(func, func_set)
-        func_set = RequestAction.imms_num_filter(func, func_set)
+        if RequestAction.uses_indexes():
+            candidate_ids = self.indexed_candidate_ids()
+            candidates = dict((func.id, func) for func in
+                              utils.filter_in_chunks(Function.objects, "id",
+                                                     candidate_ids))
+            self.filtered_function_set = [candidates[func_id]
+                                          for func_id in candidate_ids
+                                          if func_id in candidates]
+            return
+
+        func_set = RequestAction.candidates_query(self.function)
+        if self.exact_match:
+            func_set = func_set.exclude(id=self.exact_match.id)
         self.filtered_function_set = func_set.all()
 
+    @classmethod
+    def uses_indexes(cls):
+        return (constants.db_filter.USE_CANDIDATE_INDEX or
+                constants.db_filter.RETRIEVAL_MODE == LSH_RETRIEVAL)
+
+    def indexed_candidate_ids(self):
+        """
+        Finds the candidates' ids using the in-memory indexes, instead of
+        candidates_query: the LSH index in the "lsh" retrieval mode (ranked
+        by their similarity), or else the candidate index.
+        """
+        if constants.db_filter.RETRIEVAL_MODE == LSH_RETRIEVAL:
+            candidate_ids = indexes.lsh_index.find_candidates(
+                minhash.get_signature(self.function.graph.get_data()))
+        else:
+            candidate_ids = indexes.candidate_index.find_candidates(
+                RequestAction.get_filter_bounds(self.function))
+        if self.exact_match:
+            candidate_ids = candidate_ids[candidate_ids !=
+                                          self.exact_match.id]
+        return candidate_ids.tolist()
+
+    @classmethod
+    def candidates_query(cls, func):
+        func_set = Function.objects
+        for (field, bounds) in cls.get_filter_bounds(func):
+            func_set = func_set.filter(**{field + "__range": bounds})
+        return func_set
+
+    @classmethod
+    def get_filter_bounds(cls, func):
+        """
+        Returns the ranges the candidates' features must fall in, as
+        (field, (lower_bound, upper_bound)) pairs. The fields are ordered
+        as in Function's composite index.
+        """
+        const = constants.db_filter
+        coarse_bounds = cls.get_bounds_coarse_filter
+        fine_bounds = cls.get_bounds_fine_filter
+        # TODO: handle the special case of 0 strings
+        return [("num_of_insns", coarse_bounds(func.num_of_insns)),
+                ("num_of_blocks",
+                 fine_bounds(func.num_of_blocks,
+                             const.MAX_NUM_BLOCKS_DEVIATION)),
+                ("num_of_edges",
+                 fine_bounds(func.num_of_edges,
+                             const.MAX_NUM_EDGES_DEVIATION)),
+                ("num_of_calls", coarse_bounds(func.num_of_calls)),
+                ("num_of_strings", coarse_bounds(func.num_of_strings)),
+                ("num_of_imms", coarse_bounds(func.num_of_imms))]
+
     @classmethod
     def get_bounds_coarse_filter(cls, mean):
         if mean == 0:
@@ -132,92 +344,181 @@ class RequestAction:
         upper_bound = mean + delta
         return lower_bound, upper_bound
 
-    @classmethod
-    def insns_num_filter(cls, func, func_set):
-        insns_num = func.num_of_insns
-        lower_bound, upper_bound = cls.get_bounds_coarse_filter(insns_num)
-        func_set = func_set.filter(num_of_insns__range=  # @IgnorePep8
-                                   (lower_bound, upper_bound))
-        return func_set
-
-    @classmethod
-    def blocks_num_filter(cls, func, func_set):
-        num_of_blocks = func.graph.num_of_blocks
-        deviation = constants.db_filter.MAX_NUM_BLOCKS_DEVIATION
-        lower_bound, upper_bound = cls.get_bounds_fine_filter(num_of_blocks, deviation)
-        func_set = func_set.filter(graph__num_of_blocks__range=  # @IgnorePep8
-                                   (lower_bound, upper_bound))
-        return func_set
-
-    @classmethod
-    def edges_num_filter(cls, func, func_set):
-        num_of_edges = func.graph.num_of_edges
-        deviation = constants.db_filter.MAX_NUM_EDGES_DEVIATION
-        lower_bound, upper_bound = cls.get_bounds_fine_filter(num_of_edges, deviation)
-        func_set = func_set.filter(graph__num_of_edges__range=  # @IgnorePep8
-                                   (lower_bound, upper_bound))
-        return func_set
-
-    @classmethod
-    def calls_num_filter(cls, func, func_set):
-        num_of_calls = func.num_of_calls
-        lower_bound, upper_bound = cls.get_bounds_coarse_filter(num_of_calls)
-        func_set = func_set.filter(num_of_calls__range=  # @IgnorePep8
-                                   (lower_bound, upper_bound))
-        return func_set
-
-    @classmethod
-    def strings_num_filter(cls, func, func_set):
-        # TODO: handle the special case of 0
-        num_of_strings = func.num_of_strings
-        lower_bound, upper_bound = cls.get_bounds_coarse_filter(num_of_strings)
-        func_set = func_set.filter(num_of_strings__range=  # @IgnorePep8
-                                   (lower_bound, upper_bound))
-        return func_set
-
-    @classmethod
-    def imms_num_filter(cls, func, func_set):
-        num_of_imms = func.num_of_imms
-        lower_bound, upper_bound = cls.get_bounds_coarse_filter(num_of_imms)
-        func_set = func_set.filter(num_of_imms__range=  # @IgnorePep8
-                                   (lower_bound, upper_bound))
-        return func_set
-
-    def dictionary_filtering(self):
-        function_set = self.filtered_function_set
-
-        reference_itypes_dict = Counter(self.attributes["itypes"])
-        function_set = dict_filter_by_single_attr(function_set,
-                                   extract_itypes_list_function,
-                                   reference_itypes_dict,
-                                   constants.dict_filter.ITYPES_THRESHOLD)
-
-        self.filtered_function_set = function_set
+    def histogram_filtering(self, candidates):
+        """
+        The first stage of the scoring cascade: keeps the candidates whose
+        itype histograms are similar enough to the requested function's, as
+        compared by DictionarySimilarity. Runs on the candidate index, or on
+        the candidates' stored histograms.
+        """
+        threshold = constants.scoring_cascade.HISTOGRAM_THRESHOLD
+        if threshold is None or not candidates:
+            return candidates
+
+        start_time = time.time()
+        itypes_histogram = self.function.get_itypes_histogram()
+        if constants.db_filter.USE_CANDIDATE_INDEX:
+            similarities = indexes.candidate_index.itypes_similarities(
+                [candidate.id for candidate in candidates], itypes_histogram)
+        else:
+            similarities = get_itypes_similarities(candidates,
+                                                   itypes_histogram)
+        filtered_candidates = [candidate for (candidate, similarity) in
+                               zip(candidates, similarities)
+                               if similarity >= threshold]
+        self.cascade_stats.record("histogram", time.time() - start_time,
+                                  len(candidates) - len(filtered_candidates),
+                                  len(candidates))
+        return filtered_candidates
 
     def matching_grade_filtering(self):
         print "in matching grade filtering"
-        self.matching_funcs = []
-        temp_graph_nx = self.function.graph.get_data()
-        for func in self.filtered_function_set:
-            second_graph_nx = func.graph_set.all()[0].get_data()
-            print "in graph similarity"
-            graph_simialrity_grade = \
-                GraphSimilarity(temp_graph_nx, second_graph_nx).ratio()
-            print "out of graph similarity"
-            frame_similarity = \
-                FrameSimilarity(self.function.args_size,
-                                          self.function.vars_size,
-                                          self.function.regs_size,
-                                          func.args_size,
-                                          func.vars_size,
-                                          func.regs_size).ratio()
-
-            grade = (constants.matching_grade.GRAPH_SIMILARITY_WEIGHT *
-                     graph_simialrity_grade +
-                     constants.matching_grade.FRAME_SIMILARITY_WEIGHT *
-                     frame_similarity)
-            if (grade >= constants.matching_grade.MATCHING_THRESHOLD):
-                self.matching_funcs.append((func, grade))
+        candidates = self.histogram_filtering(list(self.filtered_function_set))
+        if self.top_k:
+            self.top_k_matching_grade_filtering(candidates)
+        else:
+            grades = self.matching_grades(candidates, len(candidates))
+            for (func, grade) in zip(candidates, grades):
+                if (grade >= constants.matching_grade.MATCHING_THRESHOLD):
+                    self.matching_funcs.append((func, grade))
+
+        record_cascade_stats(self.cascade_stats)
+        logger.info("scoring cascade of %s: %s",
+                    self.attributes["func_signature"],
+                    json.dumps(self.cascade_stats.stats()))
+
+    def top_k_matching_grade_filtering(self, candidates):
+        """
+        Keeps the top_k best matching candidates. The candidates are scored
+        in rounds, in the order of their grades' upper bounds, until no
+        remaining candidate can beat the k-th best grade (or reach the
+        matching threshold). An exact match is one of the top_k.
+        """
+        num_of_matches = self.top_k - len(self.matching_funcs)
+        if num_of_matches <= 0:
+            return
+        bounds = [self.matching_grade_upper_bound(candidate)
+                  for candidate in candidates]
+        order = sorted(range(len(candidates)), key=lambda x: -bounds[x])
+        const = constants.parallel_scoring
+        round_size = 1
+        if const.ENABLED:
+            round_size = get_num_of_scoring_workers() * const.CHUNKS_PER_WORKER
+
+        best = []  # a heap of the best (grade, index) pairs scored so far
+        min_grade = constants.matching_grade.MATCHING_THRESHOLD
+        for start in xrange(0, len(order), round_size):
+            if len(best) == num_of_matches:
+                min_grade = max(min_grade, best[0][0])
+            round_order = [x for x in order[start:start + round_size]
+                           if bounds[x] >= min_grade]
+            if not round_order:  # the candidates are ordered by bound
+                break
+            grades = self.matching_grades([candidates[x] for x in round_order],
+                                          len(candidates))
+            for (x, grade) in zip(round_order, grades):
+                if grade < constants.matching_grade.MATCHING_THRESHOLD:
+                    continue
+                if len(best) < num_of_matches:
+                    heapq.heappush(best, (grade, -x))
+                elif (grade, -x) > best[0]:
+                    heapq.heapreplace(best, (grade, -x))
+
+        for (grade, x) in sorted(best, reverse=True):
+            self.matching_funcs.append((candidates[-x], grade))
+
+    def matching_grade_upper_bound(self, candidate):
+        """
+        Bounds the matching grade of a candidate using only the features
+        stored with it, without loading its graph.
+        """
+        func = self.function
+        graph_bound = 1.0
+        if candidate.num_of_blocks:  # 0 until upgrade_db backfills it
+            graph_bound = graph_similarity_upper_bound(
+                func.num_of_blocks, func.get_token_counts(),
+                candidate.num_of_blocks, candidate.get_token_counts())
+        frame_similarity = FrameSimilarity(
+            func.args_size, func.vars_size, func.regs_size,
+            candidate.args_size, candidate.vars_size,
+            candidate.regs_size).ratio()
+        return (constants.matching_grade.GRAPH_SIMILARITY_WEIGHT *
+                graph_bound +
+                constants.matching_grade.FRAME_SIMILARITY_WEIGHT *
+                frame_similarity)
+
+    def matching_grades(self, candidates, num_of_candidates):
+        """
+        Returns the candidates' grades, in their order, and adds the stats
+        of their scoring cascade to the request's. num_of_candidates is the
+        number of the request's candidates, which share its clique search
+        budget.
+        """
+        const = constants.parallel_scoring
+        if const.ENABLED and len(candidates) >= const.MIN_NUM_OF_CANDIDATES:
+            return self.parallel_matching_grades(candidates,
+                                                 num_of_candidates)
+        (grades, stats) = do_matching_grades(
+            self.scoring_task(candidates,
+                              self.clique_search_time_limit(
+                                  num_of_candidates)))
+        self.cascade_stats.add(stats)
+        return grades
+
+    def parallel_matching_grades(self, candidates, num_of_candidates):
+        """
+        Spreads the candidates' scoring over the scoring pool's workers.
+        Returns the grades in the candidates' order.
+        """
+        num_of_chunks = (get_num_of_scoring_workers() *
+                         constants.parallel_scoring.CHUNKS_PER_WORKER)
+        chunk_size = int(math.ceil(len(candidates) / float(num_of_chunks)))
+        time_limit = self.clique_search_time_limit(
+            num_of_candidates, get_num_of_scoring_workers())
+        tasks = [self.scoring_task(candidates[x:x + chunk_size], time_limit)
+                 for x in xrange(0, len(candidates), chunk_size)]
+
+        grades = []
+        for (chunk_grades, chunk_stats) in \
+                get_scoring_pool().map(do_matching_grades, tasks):
+            grades += chunk_grades
+            self.cascade_stats.add(chunk_stats)
+        return grades
+
+    def scoring_task(self, candidates, clique_search_time_limit):
+        """
+        Packs everything do_matching_grades needs in order to score the
+        candidates, so that it can be sent to a worker process.
+        """
+        if self.scoring_task_prefix is None:  # once per request
+            func = self.function
+            self.scoring_task_prefix = \
+                (func.graph.get_data(),
+                 (func.args_size, func.vars_size, func.regs_size),
+                 func.graph.get_digests())
+        candidates_data = [(candidate.id,
+                            (candidate.args_size, candidate.vars_size,
+                             candidate.regs_size),
+                            (candidate.structure_digest,
+                             candidate.content_digest))
+                           for candidate in candidates]
+        return self.scoring_task_prefix + \
+            (candidates_data,
+             {"clique_search_time_limit": clique_search_time_limit})
+
+    @classmethod
+    def clique_search_time_limit(cls, num_of_candidates, num_of_workers=1):
+        """
+        Splits the request's clique search budget between the comparisons
+        with its candidates.
+        """
+        const = constants.clique_search
+        if num_of_candidates == 0:
+            return const.MAX_TIME_LIMIT
+        time_limit = (const.REQUEST_TIME_BUDGET * num_of_workers /
+                      float(num_of_candidates))
+        return min(max(time_limit, const.MIN_TIME_LIMIT),
+                   const.MAX_TIME_LIMIT)
 
     def get_descriptions(self):
         descriptions = []
@@ -242,9 +543,343 @@ class RequestAction:
         return descriptions
 
 
-def do_graph_similarity(func_graph, second_func):
-    second_graph_nx = second_func.graph_set.all()[0].get_data()
-    return GraphSimilarity(func_graph, second_graph_nx).ratio()
+class BatchRequestAction:
+    """
+    Handles requests for many functions at once. Work which the requests
+    share is done once: authentication, the exact-match lookup and the
+    candidates query. Candidate graphs are loaded once through the graph
+    cache.
+    """
+    def __init__(self, request):
+        query_dict = request.POST
+        if not 'attributes' in query_dict:
+            raise Exception("batch_request is missing attributes.")
+
+        attributes_list = json.loads(query_dict["attributes"],
+                                     encoding='ISO-8859-1',
+                                     object_hook=utils._decode_dict)
+        if not isinstance(attributes_list, list):
+            raise Exception("batch_request attributes must be a list.")
+        if len(attributes_list) > constants.batch.MAX_BATCH_SIZE:
+            raise Exception("Too many functions in batch_request.")
+
+        top_k = RequestAction.get_top_k(query_dict)
+        self.request_actions = [RequestAction(request, attributes, top_k)
+                                for attributes in attributes_list]
+
+    def process_attributes(self):
+        for request_action in self.request_actions:
+            request_action.process_attributes()
+
+    def cached_descriptions(self):
+        """
+        Returns the cached descriptions of each request (None for requests
+        which are not cached).
+        """
+        descriptions_version = get_descriptions_version()
+        return [request_action.cached_descriptions(descriptions_version)
+                for request_action in self.request_actions]
+
+    def exact_match_filtering(self, request_actions):
+        actions_by_signature = {}
+        for request_action in request_actions:
+            signature = request_action.attributes["func_signature"]
+            actions_by_signature.setdefault(signature, []).\
+                append(request_action)
+
+        for exact_match in utils.filter_in_chunks(Function.objects,
+                                                  "signature",
+                                                  actions_by_signature.keys()):
+            for request_action in actions_by_signature[exact_match.signature]:
+                request_action.set_exact_match(exact_match)
+
+    def db_filtering(self, request_actions):
+        """
+        Finds the candidates of many requests, and loads each candidate
+        once even if several requests share it.
+        """
+        if RequestAction.uses_indexes():
+            for request_action in request_actions:
+                request_action.candidate_ids = \
+                    request_action.indexed_candidate_ids()
+        else:
+            self.grouped_candidates_queries(request_actions)
+
+        candidate_ids = set()
+        for request_action in request_actions:
+            candidate_ids.update(request_action.candidate_ids)
+        candidates = dict((func.id, func) for func in
+                          utils.filter_in_chunks(Function.objects, "id",
+                                                 list(candidate_ids)))
+        for request_action in request_actions:
+            request_action.filtered_function_set = \
+                [candidates[func_id]
+                 for func_id in request_action.candidate_ids
+                 if func_id in candidates]
+
+    def grouped_candidates_queries(self, request_actions):
+        """
+        Finds the candidates of many requests using a single query per group
+        of similarly sized functions, and distributes the results.
+        """
+        request_actions = sorted(request_actions,
+                                 key=lambda r: r.function.num_of_insns)
+        group_size = constants.batch.DB_FILTER_GROUP_SIZE
+        for group in utils.chunks(request_actions, group_size):
+            all_bounds = [RequestAction.
+                          get_filter_bounds(request_action.function)
+                          for request_action in group]
+            fields = [field for (field, _) in all_bounds[0]]
+
+            func_set = Function.objects
+            for (field_index, field) in enumerate(fields):
+                lower_bound = min(bounds[field_index][1][0]
+                                  for bounds in all_bounds)
+                upper_bound = max(bounds[field_index][1][1]
+                                  for bounds in all_bounds)
+                func_set = func_set.filter(**{field + "__range":
+                                              (lower_bound, upper_bound)})
+            rows = list(func_set.values_list('id', *fields))
+
+            for (request_action, bounds) in zip(group, all_bounds):
+                excluded_id = None
+                if request_action.exact_match:
+                    excluded_id = request_action.exact_match.id
+                request_action.candidate_ids = \
+                    [row[0] for row in rows
+                     if (row[0] != excluded_id and
+                         BatchRequestAction.in_bounds(row[1:], bounds))]
+
+    @classmethod
+    def in_bounds(cls, values, bounds):
+        for (value, (_, (lower_bound, upper_bound))) in zip(values, bounds):
+            if not (lower_bound <= value <= upper_bound):
+                return False
+        return True
+
+    def get_descriptions(self):
+        """
+        Returns a list of descriptions lists, one per requested function.
+        """
+        descriptions = self.cached_descriptions()
+        pending = [request_action for (request_action, func_descriptions) in
+                   zip(self.request_actions, descriptions)
+                   if func_descriptions is None]
+
+        for request_action in pending:
+            request_action.temp_function()
+        self.exact_match_filtering(pending)
+        fuzzy_matching_actions = [request_action for request_action in pending
+                                  if request_action.fuzzy_matching_required()]
+        self.db_filtering(fuzzy_matching_actions)
+        for request_action in fuzzy_matching_actions:
+            request_action.matching_grade_filtering()
+
+        for (index, request_action) in enumerate(self.request_actions):
+            if descriptions[index] is None:
+                descriptions[index] = request_action.get_descriptions()
+                request_action.cache_descriptions(descriptions[index])
+        return descriptions
+
+
+def get_itypes_similarities(functions, itypes_histogram):
+    """
+    Returns the DictionarySimilarity of the functions' itype histograms with
+    the given {itype: count} histogram. Functions whose histograms weren't
+    computed get 1.
+    """
+    histograms = [(function.get_itypes_histogram() or {}).items()
+                  for function in functions]
+    offsets = np.zeros(len(histograms) + 1, dtype=np.int64)
+    np.cumsum([len(histogram) for histogram in histograms], out=offsets[1:])
+    pairs = np.array([pair for histogram in histograms for pair in histogram],
+                     dtype=np.int32).reshape((-1, 2))
+    similarities = dictionary_similarities(itypes_histogram, pairs[:, 0],
+                                           pairs[:, 1], offsets)
+    similarities[np.diff(offsets) == 0] = 1.0
+    return similarities
+
+
+def do_matching_grades(scoring_task):
+    """
+    Computes the matching grades of a chunk of candidates. scoring_task is
+    built by RequestAction.scoring_task. Returns the grades and the chunk's
+    CascadeStats.
+    """
+    (func_graph, func_frame, func_digests, candidates, test_dict) = \
+        scoring_task
+    cascade = ScoringCascade(func_graph, func_frame, func_digests, test_dict)
+    grades = [cascade.matching_grade(second_func_id, second_func_frame,
+                                     second_func_digests)
+              for (second_func_id, second_func_frame, second_func_digests)
+              in candidates]
+    return (grades, cascade.stats)
+
+
+#==============================================================================
+# Scoring cascade
+#==============================================================================
+CASCADE_STAGES = ["histogram", "quick_ratio", "block_matching", "graph"]
+
+
+class ScoringCascade:
+    """
+    Grades the candidates of a requested function in stages of increasing
+    cost, each of which estimates the graph similarity (candidates were
+    already filtered by the histogram stage, see
+    RequestAction.histogram_filtering):
+    quick_ratio - SequenceMatcher.quick_ratio() of the graphs' blocks merged
+    into one (see GraphSimilarity.merged_quick_ratio). It only applies to
+    graphs which are compared as wholes, since it bounds only their
+    similarity.
+    block_matching - an upper bound of the graph similarity by the blocks'
+    best matches (see GraphSimilarity.upper_bound).
+    graph - the graph similarity itself.
+    A candidate which scores below a stage's threshold (see
+    constants.scoring_cascade) is rejected without running the next stages.
+    """
+    def __init__(self, func_graph, func_frame, func_digests, test_dict=None):
+        self.func_graph = func_graph
+        self.func_frame = func_frame
+        self.func_digests = func_digests
+        self.test_dict = test_dict
+        self.stats = CascadeStats()
+
+        const = constants.scoring_cascade
+        self.thresholds = {"quick_ratio": const.QUICK_RATIO_THRESHOLD,
+                           "block_matching": const.BLOCK_MATCHING_THRESHOLD}
+        if test_dict and "cascade_thresholds" in test_dict:
+            self.thresholds.update(test_dict["cascade_thresholds"])
+
+    def matching_grade(self, second_func_id, second_func_frame,
+                       second_func_digests):
+        """
+        The digests are (structure digest, content digest) pairs, as returned
+        by Graph.get_digests. A function stored before digests were computed
+        has empty ones, and its graph is compared instead. Rejected
+        candidates are graded 0.
+        """
+        (structure_digest, content_digest) = self.func_digests
+        (second_structure_digest, second_content_digest) = \
+            second_func_digests
+        if second_content_digest and content_digest == second_content_digest:
+            graph_similarity_grade = 1.0  # no need to load the graph
+        else:
+            structure_is_equal = None
+            if second_structure_digest:
+                structure_is_equal = \
+                    structure_digest == second_structure_digest
+            content_is_equal = False if second_content_digest else None
+            second_graph = Graph.get_cached_data(second_func_id)
+            graph_similarity_grade = self.graph_similarity(
+                second_graph, structure_is_equal, content_is_equal)
+            if graph_similarity_grade is None:
+                return 0.0
+        (args_size, vars_size, regs_size) = self.func_frame
+        (second_args_size, second_vars_size, second_regs_size) = \
+            second_func_frame
+        frame_similarity = FrameSimilarity(args_size, vars_size, regs_size,
+                                           second_args_size, second_vars_size,
+                                           second_regs_size).ratio()
+
+        return (constants.matching_grade.GRAPH_SIMILARITY_WEIGHT *
+                graph_similarity_grade +
+                constants.matching_grade.FRAME_SIMILARITY_WEIGHT *
+                frame_similarity)
+
+    def graph_similarity(self, second_graph, structure_is_equal,
+                         content_is_equal):
+        """
+        Runs the stages on the candidate's graph. Returns its graph
+        similarity, or None if it was rejected.
+        """
+        graph_similarity = GraphSimilarity(self.func_graph, second_graph,
+                                           structure_is_equal,
+                                           content_is_equal)
+        stages = [("quick_ratio", graph_similarity.merged_quick_ratio),
+                  ("block_matching",
+                   lambda: graph_similarity.upper_bound(self.test_dict))]
+        for (stage, score) in stages:
+            threshold = self.thresholds[stage]
+            if threshold is None:
+                continue
+            if (stage == "quick_ratio" and
+                    not graph_similarity.
+                    merged_quick_ratio_bounds_ratio(self.test_dict)):
+                continue
+            start_time = time.time()
+            rejected = score() < threshold
+            self.stats.record(stage, time.time() - start_time, int(rejected))
+            if rejected:
+                return None
+
+        start_time = time.time()
+        ratio = graph_similarity.ratio(self.test_dict)
+        self.stats.record("graph", time.time() - start_time, 0)
+        return ratio
+
+
+class CascadeStats:
+    """
+    Counts the candidates which reached each stage of the scoring cascade
+    and the ones it rejected, and the seconds spent in it.
+    """
+    def __init__(self):
+        self.stages = dict((stage, {"candidates": 0, "rejected": 0,
+                                    "seconds": 0.0})
+                           for stage in CASCADE_STAGES)
+
+    def record(self, stage, seconds, num_of_rejected, num_of_candidates=1):
+        stage_stats = self.stages[stage]
+        stage_stats["candidates"] += num_of_candidates
+        stage_stats["rejected"] += num_of_rejected
+        stage_stats["seconds"] += seconds
+
+    def add(self, other):
+        for (stage, stage_stats) in other.stages.items():
+            for (key, value) in stage_stats.items():
+                self.stages[stage][key] += value
+
+    def stats(self):
+        return dict((stage, dict(stage_stats))
+                    for (stage, stage_stats) in self.stages.items())
+
+
+# The stats of the requests this process has handled.
+cascade_stats = CascadeStats()
+_cascade_stats_lock = threading.Lock()
+
+
+def record_cascade_stats(stats):
+    with _cascade_stats_lock:
+        cascade_stats.add(stats)
+
+
+#==============================================================================
+# Scoring pool
+#==============================================================================
+_scoring_pool = None
+
+
+def get_num_of_scoring_workers():
+    return constants.parallel_scoring.NUM_OF_WORKERS or cpu_count()
+
+
+def get_scoring_pool():
+    """
+    Returns the process-wide pool of scoring workers, forking it on first use.
+    The workers outlive the request, so their graph caches stay warm.
+    """
+    global _scoring_pool
+    if _scoring_pool is None:
+        _scoring_pool = Pool(processes=get_num_of_scoring_workers(),
+                             initializer=init_scoring_worker)
+    return _scoring_pool
+
+
+def init_scoring_worker():
+    # A forked worker must not share the parent's DB connection.
+    connection.close()
 
 
 def general_process_attributes(attributes):
@@ -302,19 +937,3 @@ def generate_function(attributes):
                         attributes["block_bounds"],
                         attributes["edges"])
     return function
-
-
-def extract_itypes_list_function(function):
-    instruction_set = function.instruction_set.all()
-    return [instruction.itype for instruction in instruction_set]
-
-
-def dict_filter_by_single_attr(func_set, list_extraction_function, ref_dict,
-                               threshold):
-    filtered_functions = []
-    for func in func_set:
-        func_dict = Counter(list_extraction_function(func))
-        grade = DictionarySimilarity(func_dict, ref_dict).ratio()
-        if (grade >= threshold):
-            filtered_functions.append(func)
-    return filtered_functions
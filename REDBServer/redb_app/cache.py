@@ -0,0 +1,214 @@
+"""
+Process-wide caches used while handling requests.
+"""
+
+# standard library imports
+from collections import OrderedDict, defaultdict
+import hashlib
+import json
+import threading
+import time
+import types
+
+import constants
+
+
+class LRUCache:
+    """
+    A least-recently-used cache bounded by the total cost of its entries.
+    Each entry is stored with a cost (e.g. its approximate size in bytes);
+    once the total cost exceeds max_cost, the least recently used entries
+    are evicted.
+    """
+    def __init__(self, max_cost):
+        self.max_cost = max_cost
+        self.cost = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (value, cost)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None, is_valid=None):
+        """
+        An entry whose value is_valid() rejects is removed, and counts as a
+        miss.
+        """
+        with self._lock:
+            try:
+                entry = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if is_valid is not None and not is_valid(entry[0]):
+                self.cost -= entry[1]
+                self._removed(key, entry[0])
+                self.misses += 1
+                return default
+            self._entries[key] = entry  # most recently used
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, cost=1):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if cost > self.max_cost:  # would evict everything else
+                return
+            self._entries[key] = (value, cost)
+            self.cost += cost
+            while self.cost > self.max_cost:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            for key in self._entries.keys():
+                self._remove(key)
+
+    def _remove(self, key):
+        (value, cost) = self._entries.pop(key)
+        self.cost -= cost
+        self._removed(key, value)
+
+    def _removed(self, key, value):
+        """
+        Called (with the lock held) whenever an entry leaves the cache.
+        """
+        pass
+
+    def hit_ratio(self):
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 0.0
+        return self.hits / float(lookups)
+
+    def stats(self):
+        return {"entries": len(self._entries),
+                "cost": self.cost,
+                "max_cost": self.max_cost,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hit_ratio()}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+
+class ResponseCache(LRUCache):
+    """
+    Caches the descriptions returned for requested functions, keyed by the
+    requested function's signature, the scoring constants' version and the
+    number of best matches requested (top_k, 0 for all).
+    Each entry remembers the ids of the functions it matched, so that a
+    change to one of their descriptions invalidates exactly the entries
+    which show it. That invalidation only reaches this process's cache, so
+    each entry also stores the descriptions' version it was computed at (see
+    models.DescriptionsVersion), and entries of older versions, e.g. after
+    another process saved a description, are dropped on read. Entries also
+    expire after max_age seconds, since functions submitted later could be
+    new matches.
+    """
+    def __init__(self, max_cost, max_age):
+        LRUCache.__init__(self, max_cost)
+        self.max_age = max_age
+        self._keys_by_function = defaultdict(set)
+
+    def get_descriptions(self, func_signature, top_k=0, version=None):
+        """
+        Returns the cached descriptions, or None. version is the current
+        version of the descriptions.
+        """
+        now = time.time()
+
+        def is_valid(entry):
+            (created_at, _, _, entry_version) = entry
+            return (now - created_at <= self.max_age and
+                    entry_version == version)
+
+        entry = self.get((func_signature, get_scoring_version(), top_k),
+                         is_valid=is_valid)
+        if entry is None:
+            return None
+        return entry[2]
+
+    def put_descriptions(self, func_signature, func_ids, descriptions,
+                         top_k=0, version=None):
+        key = (func_signature, get_scoring_version(), top_k)
+        self.put(key, (time.time(), func_ids, descriptions, version),
+                 len(json.dumps(descriptions)))
+        with self._lock:
+            if key in self._entries:
+                for func_id in func_ids:
+                    self._keys_by_function[func_id].add(key)
+
+    def invalidate_function(self, func_id):
+        """
+        Invalidates the entries which matched the function with the given id.
+        """
+        with self._lock:
+            keys = list(self._keys_by_function.get(func_id, ()))
+        for key in keys:
+            self.invalidate(key)
+
+    def invalidate_signature(self, func_signature):
+        """
+        Invalidates the entries of requests for the given function signature.
+        """
+        with self._lock:
+            keys = [key for key in self._entries if key[0] == func_signature]
+        for key in keys:
+            self.invalidate(key)
+
+    def _removed(self, key, value):
+        (_, func_ids, _, _) = value
+        for func_id in func_ids:
+            keys = self._keys_by_function.get(func_id)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_function[func_id]
+
+
+# Constants classes which don't affect the request results.
+NON_SCORING_CONSTANTS = [constants.cache, constants.parallel_scoring,
+                         constants.batch, constants.token_clusters]
+
+
+def get_scoring_version():
+    """
+    Returns a digest of the constants which affect the request results.
+    """
+    values = []
+    for (name, value) in sorted(vars(constants).items()):
+        if (type(value) is types.ClassType and
+                value not in NON_SCORING_CONSTANTS):
+            values.append((name, sorted((attr, attr_value) for
+                                        (attr, attr_value) in
+                                        vars(value).items()
+                                        if attr.isupper())))
+    return hashlib.md5(repr(values)).hexdigest()
+
+
+# Materialized function graphs (see models.Graph.get_cached_data), keyed by
+# function id.
+graph_cache = LRUCache(constants.cache.GRAPH_CACHE_MAX_BYTES)
+
+# Descriptions returned for requested functions (see
+# actions.RequestAction.cached_descriptions), keyed by function signature.
+response_cache = ResponseCache(constants.cache.RESPONSE_CACHE_MAX_BYTES,
+                               constants.cache.RESPONSE_CACHE_MAX_AGE)
+
+# Ids of recently seen String values and Call names, used while ingesting
+# functions (see models.bulk_get_or_create).
+string_id_cache = LRUCache(constants.cache.STRING_ID_CACHE_SIZE)
+call_id_cache = LRUCache(constants.cache.CALL_ID_CACHE_SIZE)
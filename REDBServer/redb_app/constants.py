@@ -10,6 +10,25 @@ REQUIRED_ATTRIBUTES = ["func_signature",
                        "graph"]
 
 
+class exact_match:
+    """
+    Constants related to requests for functions already stored in the DB.
+    """
+    # Return only the identical function's descriptions, without scoring
+    # similar functions.
+    SKIP_FUZZY_MATCHING = False
+
+
+class batch:
+    """
+    Constants related to batch requests and submits.
+    """
+    MAX_BATCH_SIZE = 5000
+    # Functions of a batch are sorted by size and their candidates are
+    # queried a group at a time, so that each query's ranges stay tight.
+    DB_FILTER_GROUP_SIZE = 50
+
+
 class db_filter:
     """
     Constants related to the preliminary filtering of the DB.
@@ -42,11 +61,47 @@ class db_filter:
 
     FINE_FILTER_ZERO_RANGE_DEV = 4
 
-class dict_filter:
+    # Filter using the in-memory indexes.CandidateIndex rather than a DB
+    # query.
+    USE_CANDIDATE_INDEX = True
+    # "range" - the functions whose sizes fall in the ranges around the
+    # requested function's.
+    # "lsh" - the functions which share the most shingles with the requested
+    # function, found by indexes.LSHIndex (see minhash).
+    RETRIEVAL_MODE = "range"
+
+
+class minhash:
+    """
+    Constants of the MinHash signatures of functions, and of the LSH index
+    which retrieves candidates by them (see db_filter.RETRIEVAL_MODE).
+    Changing SHINGLE_SIZE, NUM_OF_BANDS, BAND_SIZE or SEED invalidates the
+    stored signatures.
+    """
+    SHINGLE_SIZE = 3
+    # Functions are candidates if their signatures agree on all the hashes
+    # of at least one band.
+    NUM_OF_BANDS = 32
+    BAND_SIZE = 3
+    SEED = 1
+    # The candidates are ranked by their signatures' similarity.
+    MAX_NUM_OF_CANDIDATES = 500
+    MIN_SIMILARITY = 0.1
+
+
+class scoring_cascade:
     """
-    Constants related to the secondary filtering of the DB.
+    Thresholds of the stages of actions.ScoringCascade, which rejects most
+    candidates cheaply before comparing their graphs. None skips a stage.
     """
-    ITYPES_THRESHOLD = 0.8
+    HISTOGRAM_THRESHOLD = 0.8
+    # The quick ratio stage applies only where it bounds the graph
+    # similarity (see GraphSimilarity.merged_quick_ratio_bounds_ratio), and
+    # the block matching stage bounds it, so thresholds up to
+    # (MATCHING_THRESHOLD - FRAME_SIMILARITY_WEIGHT) /
+    # GRAPH_SIMILARITY_WEIGHT reject no matches.
+    QUICK_RATIO_THRESHOLD = 0.5
+    BLOCK_MATCHING_THRESHOLD = 0.6
 
 
 class matching_grade:
@@ -60,12 +115,79 @@ class matching_grade:
     FRAME_SIMILARITY_WEIGHT = 0.05
 
 
+class top_k:
+    """
+    Constants of top-k requests, which return only the k best matching
+    functions. Candidates are scored in the order of an upper bound of their
+    grades, until no remaining candidate can beat the k-th best grade.
+    """
+    DEFAULT_K = 0  # used when a request doesn't name k, 0 = all matches
+    MAX_K = 1000
+
+
+class parallel_scoring:
+    """
+    Constants which control scoring a request's candidates in a pool of
+    worker processes.
+    """
+    ENABLED = False
+    NUM_OF_WORKERS = None  # None means one worker per CPU
+    # Below this number of candidates, scoring in the request's own process
+    # is cheaper than sending the work to the pool.
+    MIN_NUM_OF_CANDIDATES = 50
+    CHUNKS_PER_WORKER = 4
+
+
 class graph_similarity:
     """
     Constants which affect the graph similarity algorithm.
     """
     ASSOCIATION_GRAPH_MAX_SIZE = 5000
     GRAPH_PRODUCT_MAX_SIZE = 10000
+    # "clique" - a maximum clique of the block pairs association graph.
+    # "assignment" - an assignment of blocks (requires scipy), faster and
+    # less accurate.
+    MODE = "clique"
+
+
+class clique_search:
+    """
+    Constants which bound the maximum clique search of the graph similarity.
+    Once a search runs out of its budget, the heaviest clique found so far
+    is used.
+    """
+    NODE_LIMIT = 5000000  # search nodes per comparison, 0 = unlimited
+    # Processor time (in seconds) a request spends on clique searches; each
+    # comparison gets its share, within [MIN_TIME_LIMIT, MAX_TIME_LIMIT].
+    REQUEST_TIME_BUDGET = 10.0
+    MIN_TIME_LIMIT = 0.05
+    MAX_TIME_LIMIT = 2.0
+    # Replaces graph_similarity.ASSOCIATION_GRAPH_MAX_SIZE when the search
+    # is bounded.
+    BOUNDED_ASSOCIATION_GRAPH_MAX_SIZE = 50000
+
+
+class approximate_clique:
+    """
+    Constants of the approximate maximum clique search, which the graph
+    similarity uses instead of treating the graphs as one block when their
+    product or association graph is too big for an exact search.
+    """
+    ENABLED = True
+    GRAPH_PRODUCT_MAX_SIZE = 40000
+    MAX_NUM_OF_BLOCK_PAIRS = 5000
+    NUM_OF_STARTS = 8
+    MAX_NUM_OF_SWAPS = 200
+
+
+class assignment_similarity:
+    """
+    Constants of the "assignment" graph similarity mode.
+    """
+    # The share of a matched block pair's weight which depends on its
+    # consistency with the other matched pairs.
+    NEIGHBOR_CONSISTENCY_WEIGHT = 0.5
+    NUM_OF_REFINEMENTS = 2
 
 
 class block_similarity:
@@ -86,3 +208,27 @@ class frame_similarity:
     ARGS_SIZE_WEIGHT = 0.4
     VARS_SIZE_WEIGHT = 0.3
     REGS_SIZE_WEIGHT = 0.3
+
+
+class cache:
+    """
+    Constants which bound the process-wide caches.
+    """
+    GRAPH_CACHE_MAX_BYTES = 256 * 1024 * 1024
+    RESPONSE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+    RESPONSE_CACHE_MAX_AGE = 10 * 60  # seconds
+    STRING_ID_CACHE_SIZE = 100000  # entries
+    CALL_ID_CACHE_SIZE = 50000  # entries
+    # The in-memory indexes (see indexes.py and tokens.TokenClusters) load
+    # the rows stored since their last sync. Rows committed out of id order
+    # are missed by that, so every FULL_SYNC_INTERVAL the indexes also load
+    # the stored rows they don't hold.
+    FULL_SYNC_INTERVAL = 60  # seconds
+
+
+class token_clusters:
+    """
+    Constants which affect the interning of strings and call names into
+    block tokens (see tokens.TokenClusters).
+    """
+    SYNC_INTERVAL = 5  # seconds
@@ -0,0 +1,159 @@
+"""
+A compact representation of a function's control-flow graph, used by the
+heuristics.
+"""
+
+# standard library imports
+from collections import deque
+
+# related third party imports
+import numpy as np
+
+# Rough size of a FunctionGraph and its arrays' headers, used for cache
+# accounting.
+FUNCTION_GRAPH_OVERHEAD_IN_BYTES = 1024
+
+
+class FunctionGraph(object):
+    """
+    A directed graph of blocks 0..n-1, where block 0 is the root. Each block
+    has its distance from the root (-1 if it's unreachable) and its token
+    sequence (see tokens.py).
+
+    The edges are held in CSR form (the successors of block i are
+    successors[successor_offsets[i]:successor_offsets[i + 1]], sorted), and
+    the blocks' tokens in one buffer (block i's tokens are
+    tokens[token_offsets[i]:token_offsets[i + 1]]).
+    """
+    __slots__ = ["successor_offsets", "successors", "dists", "height",
+                 "token_offsets", "tokens"]
+
+    def __init__(self, num_of_blocks, edges, dists, blocks, height=None):
+        """
+        edges : (source, target) pairs, possibly with duplicates
+        dists : the blocks' distances from the root
+        blocks : the blocks' token sequences
+        height : the max. distance from the root, computed if None
+        """
+        edges = sorted(set((int(x), int(y)) for (x, y) in edges))
+        self.successors = np.array([y for (_, y) in edges], dtype=np.int32)
+        self.successor_offsets = np.zeros(num_of_blocks + 1, dtype=np.int32)
+        np.cumsum(np.bincount(np.array([x for (x, _) in edges],
+                                       dtype=np.int32),
+                              minlength=num_of_blocks),
+                  out=self.successor_offsets[1:])
+
+        self.dists = np.array(dists, dtype=np.int32)
+        self.height = int(self.dists.max()) if height is None else height
+
+        self.token_offsets = np.zeros(num_of_blocks + 1, dtype=np.int64)
+        np.cumsum([len(block) for block in blocks],
+                  out=self.token_offsets[1:])
+        self.tokens = np.fromiter((token for block in blocks
+                                   for token in block),
+                                  dtype=np.int64,
+                                  count=int(self.token_offsets[-1]))
+
+    def __getstate__(self):
+        return dict((slot, getattr(self, slot)) for slot in self.__slots__)
+
+    def __setstate__(self, state):
+        for (slot, value) in state.items():
+            setattr(self, slot, value)
+
+    def number_of_nodes(self):
+        return len(self.dists)
+
+    def number_of_edges(self):
+        return len(self.successors)
+
+    def get_successors(self, block_id):
+        return self.successors[self.successor_offsets[block_id]:
+                               self.successor_offsets[block_id + 1]]
+
+    def edges(self):
+        """
+        Returns the edges as (source, target) pairs, sorted.
+        """
+        sources = np.repeat(np.arange(self.number_of_nodes()),
+                            np.diff(self.successor_offsets))
+        return zip(sources.tolist(), self.successors.tolist())
+
+    def has_edge(self, source, target):
+        successors = self.get_successors(source)
+        index = np.searchsorted(successors, target)
+        return index < len(successors) and successors[index] == target
+
+    def adjacency_matrix(self):
+        num_of_nodes = self.number_of_nodes()
+        adjacency = np.zeros((num_of_nodes, num_of_nodes), dtype=bool)
+        sources = np.repeat(np.arange(num_of_nodes),
+                            np.diff(self.successor_offsets))
+        adjacency[sources, self.successors] = True
+        return adjacency
+
+    def self_loops(self):
+        """
+        Returns a boolean array, which is set for the blocks with a self
+        loop.
+        """
+        sources = np.repeat(np.arange(self.number_of_nodes()),
+                            np.diff(self.successor_offsets))
+        self_loops = np.zeros(self.number_of_nodes(), dtype=bool)
+        self_loops[sources[sources == self.successors]] = True
+        return self_loops
+
+    def get_block_tokens(self, block_id):
+        """
+        Returns the block's tokens as a list (e.g. for SequenceMatcher).
+        """
+        return self.tokens[self.token_offsets[block_id]:
+                           self.token_offsets[block_id + 1]].tolist()
+
+    def get_block_lengths(self):
+        return np.diff(self.token_offsets)
+
+    def get_token_histogram(self):
+        """
+        Returns the distinct tokens of the graph's blocks, sorted, and their
+        counts.
+        """
+        return np.unique(self.tokens, return_counts=True)
+
+    def get_node_data(self, block_id):
+        return {"dist_from_root": int(self.dists[block_id]),
+                "block_data": self.get_block_tokens(block_id)}
+
+    def blocks_are_equal(self, other):
+        """
+        Returns whether both graphs' blocks have equal distances and tokens.
+        """
+        return (np.array_equal(self.dists, other.dists) and
+                np.array_equal(self.token_offsets, other.token_offsets) and
+                np.array_equal(self.tokens, other.tokens))
+
+    def estimate_size(self):
+        return (FUNCTION_GRAPH_OVERHEAD_IN_BYTES +
+                sum(getattr(self, slot).nbytes for slot in
+                    ["successor_offsets", "successors", "dists",
+                     "token_offsets", "tokens"]))
+
+
+def get_root_distances(num_of_blocks, edges):
+    """
+    Returns the blocks' distances from the root (block 0), found by BFS, or
+    -1 for blocks which are unreachable from it.
+    """
+    successors = [[] for _ in range(num_of_blocks)]
+    for (x, y) in edges:
+        successors[x].append(y)
+    distances = [-1] * num_of_blocks
+    distances[0] = 0
+    queue = deque([0])
+    while queue:
+        block_id = queue.popleft()
+        for successor in successors[block_id]:
+            if distances[successor] == -1:
+                distances[successor] = distances[block_id] + 1
+                queue.append(successor)
+    return distances
@@ -3,12 +3,29 @@ Heuristics for comparing attribute instances.
 """
 
 # standard library imports
+from collections import Counter
 from difflib import SequenceMatcher
-import networkx as nx
-from utils import CliquerGraph, test_log
+
+# related third party imports
+import numpy as np
+try:
+    from scipy.optimize import linear_sum_assignment
+except ImportError:  # only the "assignment" graph similarity mode needs it
+    linear_sum_assignment = None
+
+from utils import (CliquerGraph, approximate_maximum_weight_clique,
+                   test_log)
+from tokens import IMMEDIATE_TOKEN
 
 import constants
 
+# The rows of the association graph's compatibility matrix which are
+# computed at once, bounding its memory use.
+ASSOCIATION_GRAPH_CHUNK_SIZE = 1024
+
+CLIQUE_MODE = "clique"
+ASSIGNMENT_MODE = "assignment"
+
 
 class Heuristic:
     """ Represents a single attribute. """
@@ -65,6 +82,38 @@ class DictionarySimilarity(Heuristic):
         return self._ratio
 
 
+def dictionary_similarities(dictionary, keys, values, offsets):
+    """
+    Returns DictionarySimilarity(dictionary, other).ratio() of many other
+    dictionaries at once. Their non-zero (key, value) pairs are given in CSR
+    form: other dictionary i's keys are keys[offsets[i]:offsets[i + 1]], and
+    its values are the matching values. All the keys are non-negative ints.
+    """
+    num_of_dictionaries = len(offsets) - 1
+    size = max(max(dictionary.keys() or [0]),
+               keys.max() if len(keys) else 0) + 1
+    reference = np.zeros(size)
+    reference[dictionary.keys()] = dictionary.values()
+
+    reference_values = reference[keys]
+    values = values.astype(np.float64)
+    # (a + b) * min(a, b) / max(a, b) per key, 0 for keys missing from
+    # either dictionary.
+    weighted_values = ((reference_values + values) *
+                       np.minimum(reference_values, values) /
+                       np.maximum(reference_values, values))
+    rows = np.repeat(np.arange(num_of_dictionaries), np.diff(offsets))
+    d_sums = np.bincount(rows, weights=weighted_values,
+                         minlength=num_of_dictionaries)
+    f_sums = (reference.sum() +
+              np.bincount(rows, weights=values, minlength=num_of_dictionaries))
+
+    ratios = np.ones(num_of_dictionaries)
+    has_values = f_sums > 0
+    ratios[has_values] = d_sums[has_values] / f_sums[has_values]
+    return ratios
+
+
 class FrameSimilarity(Heuristic):
     def __init__(self, args_size_func_1, vars_size_func_1, regs_size_func_1,
                  args_size_func_2, vars_size_func_2, regs_size_func_2):
@@ -142,10 +191,137 @@ class BlockSimilarity(Heuristic):
         return self._ratio
 
 
+class BoundedBlockSimilarity:
+    """
+    Grades the similarity of the block pairs of two graphs, given the
+    threshold a pair has to reach up front. upper_bounds() bounds
+    SequenceMatcher.ratio() of all the pairs at once - by the lengths ratio
+    (as real_quick_ratio) and the token multiset overlap (as quick_ratio) -
+    so that the full alignment only runs for pairs which may reach the
+    threshold. Pairs which reach it get the same grade as
+    BlockSimilarity.ratio().
+    """
+    def __init__(self, graph_1, graph_2, threshold):
+        self.graph_1 = graph_1
+        self.graph_2 = graph_2
+        self.threshold = threshold
+        self._matchers = {}  # block of graph_2 -> matcher with it as b
+
+    def upper_bounds(self, mask):
+        """
+        Returns a matrix of upper bounds of the blocks' similarities.
+        Only the entries where mask is set are computed, the rest are 0.
+        """
+        lengths_1 = self.graph_1.get_block_lengths().astype(np.float64)
+        lengths_2 = self.graph_2.get_block_lengths().astype(np.float64)
+        total_lengths = lengths_1[:, np.newaxis] + lengths_2[np.newaxis, :]
+        # Empty sequences are identical, i.e. their ratio is 1.
+        total_lengths[total_lengths == 0] = np.inf
+        min_lengths = np.minimum(lengths_1[:, np.newaxis],
+                                 lengths_2[np.newaxis, :])
+        bounds = np.where(np.isinf(total_lengths), 1.0,
+                          2.0 * min_lengths / total_lengths)
+        mask = mask & (bounds >= self.threshold)
+
+        (counts_1, counts_2) = self._get_token_counts()
+        overlap_bounds = np.zeros(bounds.shape)
+        for i in np.flatnonzero(mask.any(axis=1)):
+            columns = np.flatnonzero(mask[i])
+            overlaps = np.minimum(counts_1[i], counts_2[columns]).sum(axis=1)
+            overlap_bounds[i, columns] = np.where(
+                np.isinf(total_lengths[i, columns]), 1.0,
+                2.0 * overlaps / total_lengths[i, columns])
+        return np.minimum(bounds, overlap_bounds)
+
+    def exact_ratio(self, i, j):
+        block_1 = self.graph_1.get_block_tokens(i)
+        matcher = self._matchers.get(j)
+        if matcher is None:
+            matcher = SequenceMatcher(b=self.graph_2.get_block_tokens(j))
+            self._matchers[j] = matcher
+        if block_1 == matcher.b:
+            return 1.0
+        matcher.set_seq1(block_1)
+        return matcher.ratio()
+
+    def _get_token_counts(self):
+        """
+        Returns the blocks' token histograms, one row per block.
+        """
+        (vocabulary, token_ids) = np.unique(
+            np.concatenate((self.graph_1.tokens, self.graph_2.tokens)),
+            return_inverse=True)
+        num_of_tokens_1 = len(self.graph_1.tokens)
+        counts = []
+        for (graph, graph_token_ids) in \
+                [(self.graph_1, token_ids[:num_of_tokens_1]),
+                 (self.graph_2, token_ids[num_of_tokens_1:])]:
+            num_of_blocks = graph.number_of_nodes()
+            block_ids = np.repeat(np.arange(num_of_blocks),
+                                  graph.get_block_lengths())
+            block_counts = np.bincount(
+                block_ids * len(vocabulary) + graph_token_ids,
+                minlength=num_of_blocks * len(vocabulary))
+            counts.append(block_counts.reshape(
+                (num_of_blocks, len(vocabulary))).astype(np.int32))
+        return counts
+
+
+def get_graph_height(graph):
+    """
+    Returns the max. distance of a block from the root.
+    """
+    return graph.height
+
+
+def graph_similarity_upper_bound(num_of_blocks_1, token_counts_1,
+                                 num_of_blocks_2, token_counts_2):
+    """
+    Bounds GraphSimilarity.ratio() of two graphs, given only their numbers of
+    blocks and their numbers of tokens of each kind (see
+    models.Function.get_token_counts).
+
+    A clique or an assignment matches at most min(n1, n2) block pairs, each
+    weighing at most 1. Comparing the blocks of graphs with equal structures,
+    or the graphs as one block, is bounded by the tokens two sequences may
+    share, as in SequenceMatcher.quick_ratio() - tokens of different kinds
+    never match.
+    """
+    min_num_of_blocks = min(num_of_blocks_1, num_of_blocks_2)
+    num_of_unmatched_blocks = (num_of_blocks_1 + num_of_blocks_2 -
+                               min_num_of_blocks)
+    if num_of_unmatched_blocks == 0:
+        return 1.0
+    matching_bound = min_num_of_blocks / float(num_of_unmatched_blocks)
+
+    # Zero immediates have no tokens, so the immediates' counts are only
+    # upper bounds. The bound is the highest when both graphs have the
+    # smaller count of them.
+    token_counts_1 = list(token_counts_1)
+    token_counts_2 = list(token_counts_2)
+    token_counts_1[IMMEDIATE_TOKEN] = token_counts_2[IMMEDIATE_TOKEN] = \
+        min(token_counts_1[IMMEDIATE_TOKEN], token_counts_2[IMMEDIATE_TOKEN])
+
+    total_length = sum(token_counts_1) + sum(token_counts_2)
+    if total_length == 0:
+        return 1.0
+    overlap = sum(min(count_1, count_2) for (count_1, count_2) in
+                  zip(token_counts_1, token_counts_2))
+    return max(matching_bound, 2.0 * overlap / total_length)
+
+
 class GraphSimilarity(Heuristic):
-    def __init__(self, graph_1, graph_2):
+    def __init__(self, graph_1, graph_2, structure_is_equal=None,
+                 content_is_equal=None):
+        """
+        structure_is_equal and content_is_equal are the results of the
+        equality checks if they are already known (e.g. from the functions'
+        digests), or None if they should be checked on the graphs.
+        """
         self.graph_1 = graph_1
         self.graph_2 = graph_2
+        self._structure_is_equal = structure_is_equal
+        self._content_is_equal = content_is_equal
 
         self.num_nodes_graph_1 = self.graph_1.number_of_nodes()
         self.num_nodes_graph_2 = self.graph_2.number_of_nodes()
@@ -156,14 +332,13 @@ class GraphSimilarity(Heuristic):
         self.size_of_min_graph = min(self.num_nodes_graph_1,
                                      self.num_nodes_graph_2)
 
-        self.graph_height_1 = \
-            max(nx.single_source_dijkstra_path_length(self.graph_1,
-                                                   0).values())
-        self.graph_height_2 = \
-            max(nx.single_source_dijkstra_path_length(self.graph_2,
-                                                      0).values())
+        self.graph_height_1 = get_graph_height(self.graph_1)
+        self.graph_height_2 = get_graph_height(self.graph_2)
         self.max_height = max(self.graph_height_1, self.graph_height_2)
 
+        self._merged_quick_ratio = None
+        self._block_pairs_bounds = None
+
     def ratio(self, test_dict=None):
         """
         if the block_pairs_similarities arg is not supplied, the block
@@ -182,7 +357,8 @@ class GraphSimilarity(Heuristic):
             self.log_decision("ratio: " + str(ratio))
             return ratio
 
-        if self.graph_product_is_too_big():
+        graph_product_is_too_big = self.graph_product_is_too_big()
+        if graph_product_is_too_big and not self.can_approximate():
             self.log_decision("graph_product_is_too_big, " +
                               "ratio_treat_as_one_block")
             ratio = self.ratio_treat_as_one_block()
@@ -190,9 +366,6 @@ class GraphSimilarity(Heuristic):
             return ratio
 
         self.block_pairs_similarities = self.calc_block_similarities()
-        self.filter_non_similar_block_pairs()
-        self.filter_non_similar_block_pairs_in_term_of_self_loop()
-        self.filter_distant_block_pairs()
 
         self.log_decision("remaining block pairs = " +
                           str(len(self.block_pairs_similarities)))
@@ -202,22 +375,41 @@ class GraphSimilarity(Heuristic):
             self.log_decision("ratio: " + str(ratio))
             return ratio
 
-        self.calc_association_graph(self.block_pairs_similarities)
-        self.log_decision("association_graph.edge_count(): " +
-                          str(self.association_graph.edge_count()))
-
-        if self.association_graph_too_many_edges():
-            self.log_decision("association_graph_too_many_edges, " +
-                              "ratio_treat_as_one_block")
-            self.association_graph.free()
-            ratio = self.ratio_treat_as_one_block()
+        if self.mode == ASSIGNMENT_MODE:
+            self.log_decision("ratio_using_assignment")
+            ratio = self.ratio_using_assignment()
             self.log_decision("ratio: " + str(ratio))
             return ratio
+
+        if graph_product_is_too_big:
+            return self.ratio_approximately_or_as_one_block(
+                "graph_product_is_too_big")
+
+        with self.calc_association_graph(self.block_pairs_similarities):
+            self.log_decision("association_graph.edge_count(): " +
+                              str(self.association_graph.edge_count()))
+
+            if self.association_graph_too_many_edges():
+                self.association_graph.free()
+                return self.ratio_approximately_or_as_one_block(
+                    "association_graph_too_many_edges")
+            else:
+                self.log_decision("ratio_using_association_graph")
+                ratio = self.ratio_using_association_graph()
+                self.log_decision("ratio: " + str(ratio))
+                return ratio
+
+    def ratio_approximately_or_as_one_block(self, reason):
+        if (self.can_approximate() and
+                len(self.block_pairs_similarities) <=
+                self.approximate_clique_max_num_of_block_pairs):
+            self.log_decision(reason + ", ratio_using_approximate_clique")
+            ratio = self.ratio_using_approximate_clique()
         else:
-            self.log_decision("ratio_using_association_graph")
-            ratio = self.ratio_using_association_graph()
-            self.log_decision("ratio: " + str(ratio))
-            return ratio
+            self.log_decision(reason + ", ratio_treat_as_one_block")
+            ratio = self.ratio_treat_as_one_block()
+        self.log_decision("ratio: " + str(ratio))
+        return ratio
 
     def set_constants(self, test_dict=None):
         self.log_decisions = test_dict and "log_decisions" in test_dict
@@ -229,9 +421,25 @@ class GraphSimilarity(Heuristic):
             self.block_similarity_threshold = \
                 constants.block_similarity.BLOCK_SIMILARITY_THRESHOLD
 
+        if test_dict and "clique_search_node_limit" in test_dict:
+            self.clique_search_node_limit = \
+                test_dict["clique_search_node_limit"]
+        else:
+            self.clique_search_node_limit = constants.clique_search.NODE_LIMIT
+
+        if test_dict and "clique_search_time_limit" in test_dict:
+            self.clique_search_time_limit = \
+                test_dict["clique_search_time_limit"]
+        else:
+            self.clique_search_time_limit = \
+                constants.clique_search.MAX_TIME_LIMIT
+
         if test_dict and "association_graph_max_size" in test_dict:
             self.association_graph_max_size = \
                 test_dict["association_graph_max_size"]
+        elif self.clique_search_node_limit or self.clique_search_time_limit:
+            self.association_graph_max_size = \
+                constants.clique_search.BOUNDED_ASSOCIATION_GRAPH_MAX_SIZE
         else:
             self.association_graph_max_size = \
                 constants.graph_similarity.ASSOCIATION_GRAPH_MAX_SIZE
@@ -250,12 +458,34 @@ class GraphSimilarity(Heuristic):
             self.min_block_dist_similarity = \
                 constants.block_similarity.MIN_BLOCK_DIST_SIMILARITY
 
+        if test_dict and "graph_similarity_mode" in test_dict:
+            self.mode = test_dict["graph_similarity_mode"]
+        else:
+            self.mode = constants.graph_similarity.MODE
+        if self.mode == ASSIGNMENT_MODE and linear_sum_assignment is None:
+            self.log_decision("scipy is missing, using " + CLIQUE_MODE)
+            self.mode = CLIQUE_MODE
+
+        if test_dict and "approximate_clique" in test_dict:
+            self.approximate_clique = test_dict["approximate_clique"]
+        else:
+            self.approximate_clique = constants.approximate_clique.ENABLED
+        self.approximate_clique_max_num_of_block_pairs = \
+            constants.approximate_clique.MAX_NUM_OF_BLOCK_PAIRS
+
         self.log_decision("block_similarity_threshold: " +
                           str(self.block_similarity_threshold) +
                           ", association_graph_max_size: " +
                           str(self.association_graph_max_size) +
                           ", min_block_dist_similarity: " +
-                          str(self.min_block_dist_similarity))
+                          str(self.min_block_dist_similarity) +
+                          ", clique_search_node_limit: " +
+                          str(self.clique_search_node_limit) +
+                          ", clique_search_time_limit: " +
+                          str(self.clique_search_time_limit) +
+                          ", approximate_clique: " +
+                          str(self.approximate_clique) +
+                          ", mode: " + self.mode)
 
     def ratio_given_similar_structures(self):
         f_sum = 0
@@ -263,8 +493,8 @@ class GraphSimilarity(Heuristic):
 
         for block_num in range(self.graph_1.number_of_nodes()):
 
-            block_data_1 = self.graph_1.node[block_num]['data']
-            block_data_2 = self.graph_2.node[block_num]['data']
+            block_data_1 = self.graph_1.get_node_data(block_num)
+            block_data_2 = self.graph_2.get_node_data(block_num)
 
             ratio = BlockSimilarity(block_data_1, block_data_2,
                                     self.graph_height_1,
@@ -285,104 +515,188 @@ class GraphSimilarity(Heuristic):
                                self.graph_height_1,
                                self.graph_height_2).ratio()
 
+    def merged_quick_ratio(self):
+        """
+        Returns SequenceMatcher.quick_ratio() of the graphs' blocks merged
+        into one, which bounds ratio_treat_as_one_block() and (since blocks
+        can't share more tokens than the whole graphs)
+        ratio_given_similar_structures().
+        """
+        if self._merged_quick_ratio is None:
+            (tokens_1, counts_1) = self.graph_1.get_token_histogram()
+            (tokens_2, counts_2) = self.graph_2.get_token_histogram()
+            total_length = counts_1.sum() + counts_2.sum()
+            if total_length == 0:
+                self._merged_quick_ratio = 1.0
+            else:
+                indexes = np.searchsorted(tokens_2, tokens_1)
+                found = indexes < len(tokens_2)
+                found[found] = tokens_2[indexes[found]] == tokens_1[found]
+                overlap = np.minimum(counts_1[found],
+                                     counts_2[indexes[found]]).sum()
+                self._merged_quick_ratio = 2.0 * overlap / total_length
+        return self._merged_quick_ratio
+
+    def merged_quick_ratio_bounds_ratio(self, test_dict=None):
+        """
+        Returns whether ratio() compares the graphs as wholes, so that
+        merged_quick_ratio() bounds it: when their structures are equal, or
+        when they are too big to compare block by block. Otherwise a clique
+        (or an assignment) of block pairs can exceed merged_quick_ratio().
+        """
+        self.set_constants(test_dict=test_dict)
+        return (self.structure_is_equal() or
+                (self.graph_product_is_too_big() and
+                 not self.can_approximate()))
+
+    def upper_bound(self, test_dict=None):
+        """
+        Bounds ratio() without searching for a clique: the block pairs are
+        filtered as in calc_block_similarities, using only the upper bounds
+        of their similarities, and no clique (or assignment) can outweigh
+        matching every block with its best counterpart. Graphs which ratio()
+        compares as wholes are bounded by merged_quick_ratio() alone, without
+        computing the block pairs' bounds.
+        """
+        if self.merged_quick_ratio_bounds_ratio(test_dict):
+            return self.merged_quick_ratio()
+        upper_bounds = self.calc_block_pairs_bounds()[3]
+        weight = min(upper_bounds.max(axis=1).sum(),
+                     upper_bounds.max(axis=0).sum())
+        matching_bound = weight / float(self.num_nodes_graph_1 +
+                                        self.num_nodes_graph_2 - weight)
+        return max(matching_bound, self.merged_quick_ratio())
+
+    def calc_block_pairs_bounds(self):
+        """
+        Returns the blocks' distance similarities, their
+        BoundedBlockSimilarity, a mask of the block pairs which are close
+        enough to the root of their graphs, agree on having a self loop and
+        may be similar enough, and the upper bounds of their similarities (0
+        for the other pairs).
+        """
+        if self._block_pairs_bounds is None:
+            distance_similarities = self.calc_distance_similarities()
+            mask = distance_similarities >= self.min_block_dist_similarity
+            mask &= self.calc_self_loop_compatibility()
+
+            block_similarity = BoundedBlockSimilarity(
+                self.graph_1, self.graph_2, self.block_similarity_threshold)
+            upper_bounds = block_similarity.upper_bounds(mask)
+            mask &= upper_bounds >= self.block_similarity_threshold
+            upper_bounds[~mask] = 0
+            self._block_pairs_bounds = (distance_similarities,
+                                        block_similarity, mask, upper_bounds)
+        return self._block_pairs_bounds
+
     def calc_block_similarities(self):
-        # TODO: don't calculate blocks similarity if blocks are too distant or
-        # if one block contains self loop and the other block doesn't.
-        block_pairs = []
-        for i in range(self.num_nodes_graph_1):
-            block_data_1 = self.graph_1.node[i]['data']
-            block_dist_from_root_1 = block_data_1['dist_from_root']
-            for j in range(self.num_nodes_graph_2):
-                block_data_2 = self.graph_2.node[j]['data']
-                block_dist_from_root_2 = block_data_2['dist_from_root']
-                distance_similarity = \
-                    self.distance_from_root_similarity(block_dist_from_root_1,
-                                                   block_dist_from_root_2)
-                if not (self.blocks_are_too_distant(distance_similarity) or
-                        self.blocks_are_non_similar_in_term_of_self_loop(i, j)):
-                    block_sim = BlockSimilarity(block_data_1, block_data_2,
-                                                self.graph_height_1,
-                                                self.graph_height_2)
-                    data_similarity = block_sim.ratio()
-                    block_pairs.append((i, j, data_similarity,
-                                        distance_similarity))
+        """
+        Returns the block pairs which are close enough to the root of their
+        graphs, agree on having a self loop and are similar enough, as
+        (block_1, block_2, data_similarity, distance_similarity) tuples.
+        """
+        (distance_similarities, block_similarity, mask, _) = \
+            self.calc_block_pairs_bounds()
 
+        block_pairs = []
+        for (i, j) in zip(*np.nonzero(mask)):
+            (i, j) = (int(i), int(j))
+            data_similarity = block_similarity.exact_ratio(i, j)
+            if data_similarity >= self.block_similarity_threshold:
+                block_pairs.append((i, j, data_similarity,
+                                    float(distance_similarities[i, j])))
         return block_pairs
 
+    def calc_distance_similarities(self):
+        dists_1 = self.graph_1.dists
+        dists_2 = self.graph_2.dists
+        dist_deltas = np.abs(dists_1[:, np.newaxis] - dists_2[np.newaxis, :])
+        if self.max_height == 0:  # both graphs contain only a single node
+            return np.ones(dist_deltas.shape)
+        return np.where(dist_deltas <= 1, 1.0,
+                        1.0 - dist_deltas / float(self.max_height))
+
+    def calc_self_loop_compatibility(self):
+        """
+        Returns a matrix which is set for the block pairs in which both
+        blocks or neither of them have a self loop.
+        """
+        self_loops_1 = self.graph_1.self_loops()
+        self_loops_2 = self.graph_2.self_loops()
+        return self_loops_1[:, np.newaxis] == self_loops_2[np.newaxis, :]
+
     def merge_all_blocks(self, graph):
         merged_block = {}
-        merged_block["block_data"] = []
-
-        for block_num in range(graph.number_of_nodes()):
-            block_data = graph.node[block_num]['data']
-            merged_block["block_data"] += block_data["block_data"]
+        merged_block["block_data"] = graph.tokens.tolist()
         merged_block["dist_from_root"] = 0
         return merged_block
 
-    def distance_from_root_similarity(self, block_1_dist_from_root,
-                                      block_2_dist_from_root):
-        block_dist_delta = abs(block_1_dist_from_root -
-                               block_2_dist_from_root)
-        if (self.max_height == 0):  # both graphs contain only a single node
-            return 1.0
-        elif (block_dist_delta <= 1):
-            return 1.0
-        else:
-            return (1.0 - block_dist_delta / float(self.max_height))
-
-    def filter_non_similar_block_pairs(self):
-        pairs = []
-        for (a, b, data_sim, distance_sim) in self.block_pairs_similarities:
-            if data_sim >= self.block_similarity_threshold:
-                pairs.append((a, b, data_sim, distance_sim))
-        self.block_pairs_similarities = pairs
-
-    def filter_distant_block_pairs(self):
-        pairs = []
-        for (a, b, data_sim, distance_sim) in self.block_pairs_similarities:
-            if distance_sim >= self.min_block_dist_similarity:
-                pairs.append((a, b, data_sim, distance_sim))
-        self.block_pairs_similarities = pairs
-
-    def filter_non_similar_block_pairs_in_term_of_self_loop(self):
-        pairs = []
-        for (a, b, data_sim, distance_sim) in self.block_pairs_similarities:
-            if ((self.graph_1.has_edge(a, a) and
-                 self.graph_2.has_edge(b, b)) or
-                (not self.graph_1.has_edge(a, a) and
-                 not self.graph_2.has_edge(b, b))):
-                pairs.append((a, b, data_sim, distance_sim))
-        self.block_pairs_similarities = pairs
-
-    def blocks_are_too_distant(self, distance_similarity):
-        return distance_similarity < self.min_block_dist_similarity
-
-    def blocks_are_non_similar_in_term_of_self_loop(self, block_1_id,
-                                                    block_2_id):
-        return (not((self.graph_1.has_edge(block_1_id, block_1_id) and
-                self.graph_2.has_edge(block_2_id, block_2_id)) or
-                (not self.graph_1.has_edge(block_1_id, block_1_id) and
-                 not self.graph_2.has_edge(block_2_id, block_2_id))))
-
     def calc_association_graph(self, nodes):
+        """
+        Connects two block pairs (i, s) and (j, t), where i != j and s != t,
+        if the edges (i, j) and (s, t) both exist or both don't, in either
+        direction. Returns the graph, which the caller should free (e.g. by
+        using it as a context manager).
+        """
         num_of_nodes = len(nodes)
         graph = CliquerGraph(num_of_nodes)
-
-        for node_index in range(num_of_nodes):
-            data_similarity = nodes[node_index][2]
-            graph.set_vertex_weight(node_index, int(data_similarity * 1000))
-
-        for x in range(num_of_nodes):
-            (i, s, data_sim, _) = nodes[x]
-            for y in range(num_of_nodes):
-                (j, t, data_sim, _) = nodes[y]
-                if s != t and i != j:
-                    if ((self.graph_1.has_edge(i, j) and
-                         self.graph_2.has_edge(s, t)) or
-                        (not self.graph_1.has_edge(i, j) and
-                         not self.graph_2.has_edge(s, t))):
-                        graph.add_edge(x, y)
+        try:
+            self._add_association_graph_data(graph, nodes)
+        except:
+            graph.free()
+            raise
         self.association_graph = graph
+        return graph
+
+    def _add_association_graph_data(self, graph, nodes):
+        num_of_nodes = len(nodes)
+        graph.set_vertex_weights([int(data_similarity * 1000) for
+                                  (_, _, data_similarity, _) in nodes])
+
+        for (rows, compatible) in self.iter_association_matrix(nodes):
+            # Each edge is added once.
+            compatible &= rows[:, np.newaxis] < np.arange(num_of_nodes)
+            (xs, ys) = np.nonzero(compatible)
+            if len(xs):
+                graph.add_edges(np.column_stack((rows[xs], ys)))
+
+    def calc_association_matrix(self, nodes):
+        """
+        Returns the adjacency matrix of the association graph (see
+        calc_association_graph).
+        """
+        num_of_nodes = len(nodes)
+        matrix = np.zeros((num_of_nodes, num_of_nodes), dtype=bool)
+        for (rows, compatible) in self.iter_association_matrix(nodes):
+            matrix[rows] = compatible
+        return matrix
+
+    def iter_association_matrix(self, nodes):
+        """
+        Yields the rows of the association graph's adjacency matrix in
+        chunks, as (row indexes, rows) pairs.
+        """
+        num_of_nodes = len(nodes)
+        blocks_1 = np.array([node[0] for node in nodes], dtype=np.intp)
+        blocks_2 = np.array([node[1] for node in nodes], dtype=np.intp)
+        adjacency_1 = self.get_adjacency_matrix(self.graph_1)
+        adjacency_2 = self.get_adjacency_matrix(self.graph_2)
+
+        for start in range(0, num_of_nodes, ASSOCIATION_GRAPH_CHUNK_SIZE):
+            rows = np.arange(start, min(start + ASSOCIATION_GRAPH_CHUNK_SIZE,
+                                        num_of_nodes))
+            (rows_1, rows_2) = (blocks_1[rows], blocks_2[rows])
+            forward = (adjacency_1[rows_1][:, blocks_1] ==
+                       adjacency_2[rows_2][:, blocks_2])
+            backward = (adjacency_1[:, rows_1].T[:, blocks_1] ==
+                        adjacency_2[:, rows_2].T[:, blocks_2])
+            compatible = ((forward | backward) &
+                          (rows_1[:, np.newaxis] != blocks_1[np.newaxis, :]) &
+                          (rows_2[:, np.newaxis] != blocks_2[np.newaxis, :]))
+            yield (rows, compatible)
+
+    def get_adjacency_matrix(self, graph):
+        return graph.adjacency_matrix()
 
     def get_clique_weight(self, clique):
         weight = 0.0
@@ -391,27 +705,121 @@ class GraphSimilarity(Heuristic):
         return weight
 
     def ratio_using_association_graph(self):
-        # print "in cliquer"
-        clique = self.association_graph.get_maximum_clique()
-        # print "out cliquer"
+        (clique, self.clique_is_optimal) = \
+            self.association_graph.find_maximum_clique(
+                node_limit=self.clique_search_node_limit,
+                time_limit=self.clique_search_time_limit)
+        if not self.clique_is_optimal:
+            self.log_decision("clique search ran out of budget")
 
         weight = self.get_clique_weight(clique)
 
-        self.association_graph.free()
-
         res = weight / (float(self.num_nodes_graph_1 +
                               self.num_nodes_graph_2 - weight))
         # print res
         return res
 
+    def ratio_using_approximate_clique(self):
+        const = constants.approximate_clique
+        clique = approximate_maximum_weight_clique(
+            self.calc_association_matrix(self.block_pairs_similarities),
+            [data_similarity for (_, _, data_similarity, _) in
+             self.block_pairs_similarities],
+            const.NUM_OF_STARTS, const.MAX_NUM_OF_SWAPS)
+
+        weight = self.get_clique_weight(clique)
+        return weight / (float(self.num_nodes_graph_1 +
+                               self.num_nodes_graph_2 - weight))
+
+    def ratio_using_assignment(self):
+        """
+        Matches blocks by a maximum weight assignment, where a block pair's
+        weight is its data similarity, scaled by its distance similarity
+        and by its consistency with the other matched pairs (see
+        calc_consistencies). The assignment is refined a few times, using
+        the consistencies with the previous assignment.
+        """
+        const = constants.assignment_similarity
+        shape = (self.num_nodes_graph_1, self.num_nodes_graph_2)
+        data_similarities = np.zeros(shape)
+        distance_similarities = np.zeros(shape)
+        for (i, j, data_sim, distance_sim) in self.block_pairs_similarities:
+            data_similarities[i, j] = data_sim
+            distance_similarities[i, j] = distance_sim
+
+        adjacency_1 = self.get_adjacency_matrix(self.graph_1)
+        adjacency_2 = self.get_adjacency_matrix(self.graph_2)
+        consistencies = np.ones(shape)
+        for _ in range(const.NUM_OF_REFINEMENTS + 1):
+            scores = (data_similarities *
+                      (1 - const.NEIGHBOR_CONSISTENCY_WEIGHT +
+                       const.NEIGHBOR_CONSISTENCY_WEIGHT * consistencies))
+            (rows, columns) = linear_sum_assignment(
+                -scores * distance_similarities)
+            matched = data_similarities[rows, columns] > 0
+            (rows, columns) = (rows[matched], columns[matched])
+            consistencies = self.calc_consistencies(adjacency_1, adjacency_2,
+                                                    rows, columns)
+
+        weight = (data_similarities[rows, columns] *
+                  (1 - const.NEIGHBOR_CONSISTENCY_WEIGHT +
+                   const.NEIGHBOR_CONSISTENCY_WEIGHT *
+                   consistencies[rows, columns])).sum()
+        return weight / (float(self.num_nodes_graph_1 +
+                               self.num_nodes_graph_2 - weight))
+
+    def calc_consistencies(self, adjacency_1, adjacency_2, rows, columns):
+        """
+        Returns, for every block pair (i, j), the share of the matched pairs
+        (rows[m], columns[m]) which are connected to it in the association
+        graph, out of the matched pairs which don't share a block with it.
+        """
+        num_of_matches = len(rows)
+        matches = np.arange(num_of_matches)
+        # The (outgoing edge, incoming edge) states of the blocks relative to
+        # the matched blocks, encoded as 0..3. Two pairs are disconnected
+        # if both their states differ, i.e. one is the other's complement.
+        states_1 = adjacency_1[:, rows] + 2 * adjacency_1[rows, :].T
+        states_2 = adjacency_2[:, columns] + 2 * adjacency_2[columns, :].T
+        disconnections = np.zeros((len(states_1), len(states_2)))
+        for state in range(4):
+            disconnections += np.dot(
+                (states_1 == state).astype(np.float64),
+                (states_2 == 3 - state).T.astype(np.float64))
+
+        # Don't count the matched pairs which share a block with the pair.
+        disconnections[rows, :] -= \
+            (states_1[rows, matches][:, np.newaxis] == 3 - states_2.T)
+        disconnections[:, columns] -= \
+            (states_1 == 3 - states_2[columns, matches][np.newaxis, :])
+        disconnections[rows, columns] += \
+            (states_1[rows, matches] == 3 - states_2[columns, matches])
+        num_of_others = np.empty(disconnections.shape)
+        num_of_others.fill(num_of_matches)
+        num_of_others[rows, :] -= 1
+        num_of_others[:, columns] -= 1
+        num_of_others[rows, columns] += 1
+
+        consistencies = np.ones(disconnections.shape)
+        has_others = num_of_others > 0
+        consistencies[has_others] -= (disconnections[has_others] /
+                                      num_of_others[has_others])
+        return consistencies
+
     def structure_and_attribues_are_equal(self):
-        return self.structure_is_equal and self.attributes_are_equal()
+        if self._content_is_equal is not None:
+            return self._content_is_equal
+        return self.structure_is_equal() and self.attributes_are_equal()
 
     def structure_is_equal(self):
-        return self.graph_1_edges == self.graph_2_edges
+        if self._structure_is_equal is not None:
+            return self._structure_is_equal
+        # FunctionGraph.edges() is sorted.
+        return (self.num_nodes_graph_1 == self.num_nodes_graph_2 and
+                self.graph_1_edges == self.graph_2_edges)
 
     def attributes_are_equal(self):
-        return self.graph_1.nodes(data=True) == self.graph_2.nodes(data=True)
+        return self.graph_1.blocks_are_equal(self.graph_2)
 
     def association_graph_too_many_edges(self):
         return (self.association_graph.edge_count() >=
@@ -424,6 +832,11 @@ class GraphSimilarity(Heuristic):
         return (self.num_nodes_graph_1 * self.num_nodes_graph_2 >=
                 self.graph_product_max_size)
 
+    def can_approximate(self):
+        return (self.approximate_clique and
+                self.num_nodes_graph_1 * self.num_nodes_graph_2 <
+                constants.approximate_clique.GRAPH_PRODUCT_MAX_SIZE)
+
     def log_decision(self, string):
         if self.log_decisions:
             test_log(string)
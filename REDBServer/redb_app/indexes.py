@@ -0,0 +1,315 @@
+"""
+In-process indexes over the stored functions, used to find the candidates
+of a request without querying the DB.
+"""
+
+# standard library imports
+import json
+import threading
+import time
+
+# related third party imports
+import numpy as np
+
+from models import Function
+from heuristics import dictionary_similarities
+import constants
+import minhash
+import utils
+
+INITIAL_CAPACITY = 1024
+
+
+class CandidateIndex:
+    """
+    Holds the features the candidates are filtered by in arrays, one column
+    per feature, and answers range queries over them with vectorized masks.
+    The functions' itype histograms are held in CSR form, so that they are
+    compared with a request's histogram at once.
+    The index is loaded from the DB on first use, and every query first
+    loads the functions stored since (by any process), so it stays up to
+    date with submits.
+    """
+    FIELDS = ["num_of_insns", "num_of_blocks", "num_of_edges", "num_of_calls",
+              "num_of_strings", "num_of_imms", "args_size", "vars_size",
+              "regs_size", "frame_size"]
+
+    def __init__(self):
+        # Row 0 holds the function ids, row i + 1 holds FIELDS[i].
+        self._columns = np.zeros((len(self.FIELDS) + 1, INITIAL_CAPACITY),
+                                 dtype=np.int64)
+        self._size = 0
+        # Row i's histogram is the (itype, count) pairs
+        # _itypes[_histogram_offsets[i]:_histogram_offsets[i + 1]] and
+        # _itype_counts[...]. Histograms which weren't computed are empty.
+        self._histogram_offsets = np.zeros(INITIAL_CAPACITY + 1,
+                                           dtype=np.int64)
+        self._itypes = np.zeros(INITIAL_CAPACITY, dtype=np.int32)
+        self._itype_counts = np.zeros(INITIAL_CAPACITY, dtype=np.int32)
+        self._max_id = 0
+        self._last_full_sync = 0
+        self._lock = threading.Lock()
+
+    def sync(self):
+        """
+        Loads the functions stored since the last sync, and every
+        FULL_SYNC_INTERVAL also the stored functions which aren't indexed
+        (i.e. committed out of id order).
+        """
+        with self._lock:
+            fields = ["id"] + self.FIELDS + ["itypes_histogram"]
+            rows = list(Function.objects.filter(id__gt=self._max_id).
+                        order_by('id').values_list(*fields))
+            now = time.time()
+            if self._max_id == 0:  # loaded all the stored functions
+                self._last_full_sync = now
+            elif (now - self._last_full_sync >=
+                    constants.cache.FULL_SYNC_INTERVAL):
+                self._last_full_sync = now
+                indexed_ids = np.concatenate(
+                    [self._columns[0, :self._size],
+                     np.array([row[0] for row in rows], dtype=np.int64)])
+                rows += _get_unindexed_rows(Function.objects, indexed_ids,
+                                            fields)
+            if not rows:
+                return
+            new_columns = np.array([row[:-1] for row in rows],
+                                   dtype=np.int64).T
+            new_size = self._size + len(rows)
+            if new_size > self._columns.shape[1]:
+                columns = np.zeros((self._columns.shape[0],
+                                    max(new_size, 2 * self._columns.shape[1])),
+                                   dtype=np.int64)
+                columns[:, :self._size] = self._columns[:, :self._size]
+                self._columns = columns
+            self._columns[:, self._size:new_size] = new_columns
+            self._add_histograms([row[-1] for row in rows])
+            self._size = new_size
+            self._max_id = max(self._max_id, int(new_columns[0].max()))
+            if np.any(np.diff(self._columns[0, :self._size]) < 0):
+                self._sort_by_id()
+
+    def _sort_by_id(self):
+        """
+        Keeps the rows in id order, which itypes_similarities relies on.
+        """
+        order = np.argsort(self._columns[0, :self._size], kind='mergesort')
+        self._columns[:, :self._size] = self._columns[:, order]
+        (offsets, positions) = self._get_histogram_positions(order)
+        self._itypes[:len(positions)] = self._itypes[positions]
+        self._itype_counts[:len(positions)] = self._itype_counts[positions]
+        self._histogram_offsets[:self._size + 1] = offsets
+
+    def _add_histograms(self, serialized_histograms):
+        pairs = [json.loads(histogram) if histogram else []
+                 for histogram in serialized_histograms]
+        lengths = [len(histogram) for histogram in pairs]
+        pairs = np.array([pair for histogram in pairs for pair in histogram],
+                         dtype=np.int32).reshape((-1, 2))
+
+        start = self._histogram_offsets[self._size]
+        end = start + len(pairs)
+        if self._size + len(lengths) + 1 > len(self._histogram_offsets):
+            self._histogram_offsets = _grow(self._histogram_offsets,
+                                            self._size + len(lengths) + 1)
+        if end > len(self._itypes):
+            self._itypes = _grow(self._itypes, end)
+            self._itype_counts = _grow(self._itype_counts, end)
+        self._histogram_offsets[self._size + 1:
+                                self._size + len(lengths) + 1] = \
+            start + np.cumsum(lengths)
+        self._itypes[start:end] = pairs[:, 0]
+        self._itype_counts[start:end] = pairs[:, 1]
+
+    def find_candidates(self, bounds):
+        """
+        bounds are (field, (lower_bound, upper_bound)) pairs, as returned by
+        actions.RequestAction.get_filter_bounds. Returns the ids of the
+        functions whose fields all fall in their (inclusive) ranges.
+        """
+        self.sync()
+        with self._lock:
+            columns = self._columns
+            size = self._size
+
+        mask = np.ones(size, dtype=bool)
+        for (field, (lower_bound, upper_bound)) in bounds:
+            column = columns[self.FIELDS.index(field) + 1, :size]
+            np.logical_and(mask, column >= lower_bound, out=mask)
+            np.logical_and(mask, column <= upper_bound, out=mask)
+        return columns[0, :size][mask]
+
+    def itypes_similarities(self, func_ids, itypes_histogram):
+        """
+        Returns the DictionarySimilarity of the itype histograms of the
+        functions with the given ids (which must be indexed) with the given
+        {itype: count} histogram. Functions whose histograms weren't computed
+        get 1.
+        """
+        self.sync()
+        with self._lock:
+            ids = self._columns[0, :self._size]
+            offsets = self._histogram_offsets
+            itypes = self._itypes
+            itype_counts = self._itype_counts
+
+        rows = np.searchsorted(ids, func_ids)
+        (row_offsets, positions) = self._get_histogram_positions(rows,
+                                                                 offsets)
+        similarities = dictionary_similarities(itypes_histogram,
+                                               itypes[positions],
+                                               itype_counts[positions],
+                                               row_offsets)
+        similarities[np.diff(row_offsets) == 0] = 1.0
+        return similarities
+
+    def _get_histogram_positions(self, rows, offsets=None):
+        """
+        Gathers the rows' (itype, count) pairs: returns the CSR offsets of
+        the rows' histograms, and the positions of their pairs in _itypes
+        and _itype_counts.
+        """
+        if offsets is None:
+            offsets = self._histogram_offsets
+        starts = offsets[rows]
+        lengths = offsets[rows + 1] - starts
+        row_offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=row_offsets[1:])
+        positions = (np.arange(row_offsets[-1]) +
+                     np.repeat(starts - row_offsets[:-1], lengths))
+        return (row_offsets, positions)
+
+    def __len__(self):
+        return self._size
+
+
+class LSHIndex:
+    """
+    Finds the functions whose MinHash signatures (see minhash.py) agree with
+    a requested function's on all the hashes of at least one band, using a
+    bucket per band key, and ranks them by their signatures' similarity.
+    The index is loaded from the functions' stored signatures on first use,
+    and every query first loads the functions stored since, as the
+    CandidateIndex does. Functions whose signatures weren't computed yet
+    are not indexed until they are.
+    """
+    def __init__(self):
+        const = constants.minhash
+        self._ids = np.zeros(INITIAL_CAPACITY, dtype=np.int64)
+        self._signatures = np.zeros((INITIAL_CAPACITY, const.NUM_OF_BANDS *
+                                     const.BAND_SIZE), dtype=np.uint32)
+        self._buckets = [{} for _ in range(const.NUM_OF_BANDS)]
+        self._size = 0
+        self._max_id = 0
+        self._last_full_sync = 0
+        self._lock = threading.Lock()
+
+    def sync(self):
+        """
+        Loads the signed functions stored since the last sync, and every
+        FULL_SYNC_INTERVAL also the signed functions which aren't indexed
+        (i.e. committed out of id order, or signed by upgrade_db since).
+        """
+        with self._lock:
+            fields = ['id', 'minhash_signature']
+            signed_functions = Function.objects.exclude(minhash_signature="")
+            rows = list(signed_functions.filter(id__gt=self._max_id).
+                        order_by('id').values_list(*fields))
+            now = time.time()
+            if self._max_id == 0:  # loaded all the signed functions
+                self._last_full_sync = now
+            elif (now - self._last_full_sync >=
+                    constants.cache.FULL_SYNC_INTERVAL):
+                self._last_full_sync = now
+                indexed_ids = np.concatenate(
+                    [self._ids[:self._size],
+                     np.array([row[0] for row in rows], dtype=np.int64)])
+                rows += _get_unindexed_rows(signed_functions, indexed_ids,
+                                            fields)
+            if not rows:
+                return
+
+            new_size = self._size + len(rows)
+            if new_size > len(self._ids):
+                self._ids = _grow(self._ids, new_size)
+                self._signatures = _grow(self._signatures, new_size)
+            self._ids[self._size:new_size] = [func_id for (func_id, _) in rows]
+            self._signatures[self._size:new_size] = \
+                [minhash.deserialize_signature(signature)
+                 for (_, signature) in rows]
+            self._max_id = max(self._max_id,
+                               int(self._ids[self._size:new_size].max()))
+            if np.any(np.diff(self._ids[:new_size]) < 0):
+                # Keep the rows in id order, and rebuild the buckets.
+                order = np.argsort(self._ids[:new_size], kind='mergesort')
+                self._ids[:new_size] = self._ids[order]
+                self._signatures[:new_size] = self._signatures[order]
+                self._buckets = [{} for _ in self._buckets]
+                self._size = 0
+            self._add_to_buckets(new_size)
+
+    def _add_to_buckets(self, new_size):
+        """
+        Adds the rows from _size to new_size to the buckets.
+        """
+        band_keys = minhash.get_band_keys(self._signatures[self._size:
+                                                           new_size])
+        for (row, row_band_keys) in enumerate(band_keys.tolist(),
+                                              self._size):
+            for (buckets, band_key) in zip(self._buckets, row_band_keys):
+                buckets.setdefault(band_key, []).append(row)
+        self._size = new_size
+
+    def find_candidates(self, signature):
+        """
+        Returns the ids of the functions which share a band with the given
+        signature, and whose signatures' similarity with it is at least
+        MIN_SIMILARITY, ranked by it. At most MAX_NUM_OF_CANDIDATES ids are
+        returned.
+        """
+        const = constants.minhash
+        self.sync()
+        band_keys = minhash.get_band_keys(signature[np.newaxis, :])[0]
+        with self._lock:
+            rows = set()
+            for (buckets, band_key) in zip(self._buckets, band_keys.tolist()):
+                rows.update(buckets.get(band_key, ()))
+            ids = self._ids
+            signatures = self._signatures
+
+        rows = np.array(sorted(rows), dtype=np.int64)
+        similarities = (signatures[rows] == signature).mean(axis=1)
+        rows = rows[similarities >= const.MIN_SIMILARITY]
+        similarities = similarities[similarities >= const.MIN_SIMILARITY]
+        # A stable sort keeps functions of equal similarities in id order.
+        ranking = np.argsort(-similarities, kind='mergesort')
+        return ids[rows[ranking[:const.MAX_NUM_OF_CANDIDATES]]]
+
+    def __len__(self):
+        return self._size
+
+
+def _get_unindexed_rows(queryset, indexed_ids, fields):
+    """
+    Returns the values of the fields of queryset's rows whose ids are not in
+    indexed_ids, ordered by id.
+    """
+    stored_ids = np.fromiter(queryset.values_list('id', flat=True),
+                             dtype=np.int64)
+    missing_ids = np.setdiff1d(stored_ids, indexed_ids).tolist()
+    rows = []
+    for chunk in utils.chunks(missing_ids, utils.MAX_IN_QUERY_SIZE):
+        rows += queryset.filter(id__in=chunk).order_by('id').\
+            values_list(*fields)
+    return rows
+
+
+def _grow(array, min_size):
+    grown = np.zeros((max(min_size, 2 * len(array)),) + array.shape[1:],
+                     dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+
+candidate_index = CandidateIndex()
+lsh_index = LSHIndex()
@@ -0,0 +1,37 @@
+"""
+Shows how the DB executes the candidates query of a request, to verify that
+it stays an index range scan.
+"""
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from redb_app.actions import RequestAction
+from redb_app.models import Function
+
+
+class Command(BaseCommand):
+    args = "<function_id>"
+    help = ("Prints the query plan of the candidates query for a request "
+            "of the stored function with the given id.")
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Usage: explain_candidates " + self.args)
+        try:
+            func = Function.objects.get(id=int(args[0]))
+        except (ValueError, Function.DoesNotExist):
+            raise CommandError("No function with id " + args[0])
+
+        func_set = RequestAction.candidates_query(func)
+        sql, params = func_set.query.sql_with_params()
+        self.stdout.write(sql % tuple(params))
+
+        if connection.vendor == "sqlite":
+            explain = "EXPLAIN QUERY PLAN "
+        else:
+            explain = "EXPLAIN "
+        cursor = connection.cursor()
+        cursor.execute(explain + sql, params)
+        for row in cursor.fetchall():
+            self.stdout.write(" | ".join(unicode(column) for column in row))
+        self.stdout.write("%d candidates" % func_set.count())
@@ -0,0 +1,184 @@
+"""
+Brings an existing DB up to date with the current models: adds the columns
+and indexes introduced since the tables were created and backfills their
+data.
+
+Restart running servers after upgrading: they keep the graphs, clusters and
+indexes they loaded before, and e.g. only pick up the backfilled MinHash
+signatures in a full sync of their LSH index (see
+constants.cache.FULL_SYNC_INTERVAL).
+"""
+from collections import Counter
+import json
+
+from django.core.management.base import NoArgsCommand
+from django.db import connection, transaction
+from django.db.models import Q
+
+from redb_app.models import (Function, Graph, String, Call, Instruction,
+                             string_clusters, call_clusters)
+from redb_app.utils import add_missing_columns, create_missing_indexes
+from redb_app import minhash
+
+BACKFILL_CHUNK_SIZE = 500
+
+
+class Command(NoArgsCommand):
+    help = ("Adds missing columns and indexes to the REDB tables and "
+            "backfills data which is precomputed at submit time.")
+
+    def handle_noargs(self, **options):
+        for model in [Function, Graph, String, Call]:
+            for column in add_missing_columns(model):
+                self.stdout.write("Added column %s.%s" %
+                                  (model._meta.db_table, column))
+            create_missing_indexes(model)
+
+        self.backfill_graph_counts()
+        self.backfill_heights()
+        self.backfill_tokens(String, "value", string_clusters)
+        self.backfill_tokens(Call, "name", call_clusters)
+        self.backfill_blocks()
+        self.backfill_digests()
+        self.backfill_itypes_histograms()
+        self.backfill_signatures()
+
+        self.analyze([Function, Graph, String, Call])
+        self.stdout.write("Done.")
+
+    def analyze(self, models):
+        """
+        Refreshes the statistics the query planner uses to pick an index.
+        """
+        cursor = connection.cursor()
+        if connection.vendor in ["sqlite", "postgresql"]:
+            cursor.execute("ANALYZE")
+        elif connection.vendor == "mysql":
+            cursor.execute("ANALYZE TABLE " +
+                           ", ".join(connection.ops.
+                                     quote_name(model._meta.db_table)
+                                     for model in models))
+            cursor.fetchall()  # ANALYZE TABLE returns a status per table
+        else:
+            return
+        transaction.commit_unless_managed()
+
+    def backfill_graph_counts(self):
+        # Every graph has at least one block, so 0 marks missing counts.
+        cursor = connection.cursor()
+        cursor.execute("UPDATE %(function)s SET "
+                       "num_of_blocks = (SELECT num_of_blocks FROM %(graph)s "
+                       "WHERE %(graph)s.function_id = %(function)s.id), "
+                       "num_of_edges = (SELECT num_of_edges FROM %(graph)s "
+                       "WHERE %(graph)s.function_id = %(function)s.id) "
+                       "WHERE num_of_blocks = 0" %
+                       {"function": Function._meta.db_table,
+                        "graph": Graph._meta.db_table})
+        transaction.commit_unless_managed()
+        self.stdout.write("Backfilled graph counts of %d functions" %
+                          cursor.rowcount)
+
+    def backfill_heights(self):
+        # Also converts the distances from the {block id: distance} format.
+        graph_ids = list(Graph.objects.filter(height=-1).
+                         values_list('id', flat=True))
+        self.stdout.write("Backfilling heights of %d graphs" % len(graph_ids))
+
+        for start in xrange(0, len(graph_ids), BACKFILL_CHUNK_SIZE):
+            chunk = graph_ids[start:start + BACKFILL_CHUNK_SIZE]
+            with transaction.commit_on_success():
+                for (graph_id, num_of_blocks, distances) in \
+                        Graph.objects.filter(id__in=chunk).\
+                        values_list('id', 'num_of_blocks', 'distances'):
+                    distances = Graph.deserialize_distances(distances,
+                                                            num_of_blocks)
+                    Graph.objects.filter(id=graph_id).\
+                        update(distances=json.dumps(distances),
+                               height=max(distances))
+            self.stdout.write("%d/%d" % (start + len(chunk), len(graph_ids)))
+
+    def backfill_tokens(self, model, field, clusters):
+        # Values are clustered in id order, as if they were submitted now.
+        rows = list(model.objects.filter(token=0).order_by('id').
+                    values_list('id', field))
+        self.stdout.write("Backfilling tokens of %d %s rows" %
+                          (len(rows), model.__name__))
+
+        clusters.sync(force=True)
+        for start in xrange(0, len(rows), BACKFILL_CHUNK_SIZE):
+            chunk = rows[start:start + BACKFILL_CHUNK_SIZE]
+            with transaction.commit_on_success():
+                for (row_id, value) in chunk:
+                    model.objects.filter(id=row_id).\
+                        update(token=clusters.get_cluster_id(value, add=True))
+            self.stdout.write("%d/%d" % (start + len(chunk), len(rows)))
+
+    def backfill_blocks(self):
+        # Blocks serialized before tokens were interned are rebuilt as well.
+        graph_ids = list(Graph.objects.
+                         filter(Q(blocks="") | Q(blocks__contains='["')).
+                         values_list('id', flat=True))
+        self.stdout.write("Backfilling blocks of %d graphs" % len(graph_ids))
+
+        for start in xrange(0, len(graph_ids), BACKFILL_CHUNK_SIZE):
+            chunk = graph_ids[start:start + BACKFILL_CHUNK_SIZE]
+            for graph in Graph.objects.select_related('function').\
+                    filter(id__in=chunk):
+                graph.get_data()
+                Graph.objects.filter(id=graph.id).\
+                    update(blocks=graph.serialize_blocks())
+            self.stdout.write("%d/%d" % (start + len(chunk), len(graph_ids)))
+
+    def backfill_digests(self):
+        graph_ids = list(Graph.objects.filter(function__content_digest="").
+                         values_list('id', flat=True))
+        self.stdout.write("Backfilling digests of %d functions" %
+                          len(graph_ids))
+
+        for start in xrange(0, len(graph_ids), BACKFILL_CHUNK_SIZE):
+            chunk = graph_ids[start:start + BACKFILL_CHUNK_SIZE]
+            with transaction.commit_on_success():
+                for graph in Graph.objects.select_related('function').\
+                        filter(id__in=chunk):
+                    (structure_digest, content_digest) = graph.get_digests()
+                    Function.objects.filter(id=graph.function_id).\
+                        update(structure_digest=structure_digest,
+                               content_digest=content_digest)
+            self.stdout.write("%d/%d" % (start + len(chunk), len(graph_ids)))
+
+    def backfill_itypes_histograms(self):
+        func_ids = list(Function.objects.filter(itypes_histogram="").
+                        values_list('id', flat=True))
+        self.stdout.write("Backfilling itype histograms of %d functions" %
+                          len(func_ids))
+
+        for start in xrange(0, len(func_ids), BACKFILL_CHUNK_SIZE):
+            chunk = func_ids[start:start + BACKFILL_CHUNK_SIZE]
+            histograms = dict((func_id, Counter()) for func_id in chunk)
+            for (func_id, itype) in Instruction.objects.\
+                    filter(function_id__in=chunk).\
+                    values_list('function_id', 'itype'):
+                histograms[func_id][itype] += 1
+            with transaction.commit_on_success():
+                for (func_id, histogram) in histograms.items():
+                    Function.objects.filter(id=func_id).\
+                        update(itypes_histogram=Function.
+                               serialize_itypes_histogram(histogram))
+            self.stdout.write("%d/%d" % (start + len(chunk), len(func_ids)))
+
+    def backfill_signatures(self):
+        graph_ids = list(Graph.objects.filter(function__minhash_signature="").
+                         values_list('id', flat=True))
+        self.stdout.write("Backfilling MinHash signatures of %d functions" %
+                          len(graph_ids))
+
+        for start in xrange(0, len(graph_ids), BACKFILL_CHUNK_SIZE):
+            chunk = graph_ids[start:start + BACKFILL_CHUNK_SIZE]
+            with transaction.commit_on_success():
+                for graph in Graph.objects.select_related('function').\
+                        filter(id__in=chunk):
+                    signature = minhash.get_signature(graph.get_data())
+                    Function.objects.filter(id=graph.function_id).\
+                        update(minhash_signature=minhash.
+                               serialize_signature(signature))
+            self.stdout.write("%d/%d" % (start + len(chunk), len(graph_ids)))
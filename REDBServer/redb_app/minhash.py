@@ -0,0 +1,110 @@
+"""
+MinHash signatures of functions, used to retrieve candidates which share
+many token shingles (see tokens.py) with a requested function.
+
+A shingle is a run of SHINGLE_SIZE consecutive tokens of a block (a shorter
+block is a shingle of its own). The share of equal entries of two
+signatures estimates the Jaccard similarity of the functions' shingle sets.
+"""
+
+# standard library imports
+import binascii
+
+# related third party imports
+import numpy as np
+
+import constants
+
+# Mixes a shingle's tokens into its hash.
+SHINGLE_HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+HASH_VALUE_SHIFT = np.uint64(32)
+
+
+def _get_hash_functions():
+    const = constants.minhash
+    random_state = np.random.RandomState(const.SEED)
+    num_of_hashes = const.NUM_OF_BANDS * const.BAND_SIZE
+    # Multiply-shift hashing: (a * x + b) >> 32, with an odd a.
+    multipliers = (random_state.randint(0, 1 << 31, num_of_hashes).
+                   astype(np.uint64) << HASH_VALUE_SHIFT |
+                   random_state.randint(0, 1 << 31, num_of_hashes).
+                   astype(np.uint64) << np.uint64(1) | np.uint64(1))
+    increments = (random_state.randint(0, 1 << 31, num_of_hashes).
+                  astype(np.uint64) << HASH_VALUE_SHIFT)
+    return (multipliers, increments)
+
+
+_hash_functions = None
+
+
+def get_shingles(function_graph):
+    """
+    Returns the hashes of the graph's distinct shingles, sorted.
+    """
+    shingle_size = constants.minhash.SHINGLE_SIZE
+    num_of_tokens = len(function_graph.tokens)
+    lengths = function_graph.get_block_lengths()
+    if num_of_tokens == 0:
+        return np.zeros(0, dtype=np.uint64)
+
+    # The end of the block of each token.
+    ends = np.repeat(function_graph.token_offsets[1:], lengths)
+    positions = np.arange(num_of_tokens)
+    # 0 can't be told apart from a missing token.
+    block_tokens = function_graph.tokens.astype(np.uint64) + np.uint64(1)
+    hashes = np.zeros(num_of_tokens, dtype=np.uint64)
+    for offset in range(shingle_size):
+        in_block = positions + offset < ends
+        hashes *= SHINGLE_HASH_MULTIPLIER
+        hashes[in_block] += block_tokens[positions[in_block] + offset]
+
+    # A shingle starts at each token which has SHINGLE_SIZE - 1 tokens after
+    # it in its block, or at the start of a shorter block.
+    starts = np.repeat(function_graph.token_offsets[:-1], lengths)
+    is_shingle = ((positions + shingle_size <= ends) |
+                  ((positions == starts) & (ends - starts < shingle_size)))
+    return np.unique(hashes[is_shingle])
+
+
+def get_signature(function_graph):
+    """
+    Returns the graph's MinHash signature, an array of
+    NUM_OF_BANDS * BAND_SIZE uint32 hashes.
+    """
+    global _hash_functions
+    if _hash_functions is None:
+        _hash_functions = _get_hash_functions()
+    (multipliers, increments) = _hash_functions
+
+    shingles = get_shingles(function_graph)
+    if len(shingles) == 0:
+        signature = np.empty(len(multipliers), dtype=np.uint32)
+        signature.fill(np.iinfo(np.uint32).max)
+        return signature
+    hashes = ((multipliers[:, np.newaxis] * shingles[np.newaxis, :] +
+               increments[:, np.newaxis]) >> HASH_VALUE_SHIFT)
+    return hashes.min(axis=1).astype(np.uint32)
+
+
+def get_band_keys(signatures):
+    """
+    Returns the keys of the bands of each of the signatures (one per row),
+    as a matrix with one column per band. Signatures which agree on all the
+    hashes of a band have the same key for it.
+    """
+    const = constants.minhash
+    bands = signatures.reshape((len(signatures), const.NUM_OF_BANDS,
+                                const.BAND_SIZE)).astype(np.uint64)
+    keys = np.zeros(bands.shape[:2], dtype=np.uint64)
+    for row in range(const.BAND_SIZE):
+        keys = keys * SHINGLE_HASH_MULTIPLIER + bands[:, :, row]
+    return keys
+
+
+def serialize_signature(signature):
+    return binascii.hexlify(signature.astype('<u4').tostring())
+
+
+def deserialize_signature(serialized_signature):
+    return np.frombuffer(binascii.unhexlify(serialized_signature),
+                         dtype='<u4').astype(np.uint32)
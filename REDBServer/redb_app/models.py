@@ -2,18 +2,23 @@
 Django models representing functions and descriptions.
 """
 # related third party imports
-from django.db import models
+from django.db import models, transaction, IntegrityError
 from django.contrib.auth.models import User
-import networkx as nx
+from collections import Counter
 import json
+import hashlib
 from django.utils.encoding import smart_text
 import utils
-from difflib import SequenceMatcher as SM
 import constants
+import cache
+import tokens
+import graphs
+import minhash
 
 MAX_EXE_NAME_LENGTH = 255
 EXE_DIGEST_SIZE_IN_BYTES = 32
 FUNC_DIGEST_SIZE_IN_BYTES = 32
+GRAPH_DIGEST_SIZE_IN_BYTES = 32
 PASSWORD_DIGEST_SIZE_IN_BYTES = 32
 MAX_CALL_NAME_LENGTH = 100
 MAX_USER_NAME_LENGTH = 25
@@ -32,11 +37,32 @@ class Function(models.Model):
         models.PositiveSmallIntegerField()  # Counting duplicates
     num_of_imms = models.PositiveSmallIntegerField()
     num_of_insns = models.PositiveIntegerField()
+    # Copies of the graph's counts, so that the candidates query needs no
+    # join.
+    num_of_blocks = models.PositiveIntegerField(default=0)
+    num_of_edges = models.PositiveIntegerField(default=0)
+    # See Graph.get_digests.
+    structure_digest = models.CharField(max_length=GRAPH_DIGEST_SIZE_IN_BYTES,
+                                        blank=True, default="")
+    content_digest = models.CharField(max_length=GRAPH_DIGEST_SIZE_IN_BYTES,
+                                      blank=True, default="")
+    # The number of instructions of each itype, serialized by
+    # serialize_itypes_histogram(), or "" if it wasn't computed yet.
+    itypes_histogram = models.TextField(blank=True, default="")
+    # The graph's MinHash signature, serialized by
+    # minhash.serialize_signature(), or "" if it wasn't computed yet.
+    minhash_signature = models.TextField(blank=True, default="")
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     func_name = models.TextField()
     exe_name = models.TextField()
 
+    class Meta:
+        # Fit the range filters of actions.RequestAction.candidates_query.
+        index_together = [["num_of_insns", "num_of_blocks", "num_of_edges",
+                           "num_of_calls", "num_of_strings", "num_of_imms"],
+                          ["num_of_blocks", "num_of_edges", "num_of_insns"]]
+
     def initialize(self, func_signature, exe_signature, args_size, vars_size,
                    regs_size, frame_size, num_of_strings, num_of_calls,
                    num_of_imms, num_of_insns, func_name, exe_name, immediates,
@@ -52,6 +78,8 @@ class Function(models.Model):
         self.num_of_insns = num_of_insns
         self.func_name = smart_text(func_name)
         self.exe_name = smart_text(exe_name)
+        self.itypes_histogram = \
+            Function.serialize_itypes_histogram(Counter(itypes))
 
         self.instructions = []
 
@@ -77,34 +105,66 @@ class Function(models.Model):
 
         self.graph = Graph()
         self.graph.initialize(block_bounds, edges, self)
+        self.num_of_blocks = self.graph.num_of_blocks
+        self.num_of_edges = self.graph.num_of_edges
         self.executable = Executable()
         self.executable.initialize(exe_signature, self, exe_name)
 
     def get_data(self):
         pass
 
+    @classmethod
+    def serialize_itypes_histogram(cls, histogram):
+        """
+        Serializes an {itype: count} dictionary as compact JSON
+        [[itype, count], ...] pairs, sorted by itype.
+        """
+        return json.dumps(sorted(histogram.items()), separators=(',', ':'))
+
+    def get_itypes_histogram(self):
+        """
+        Returns the number of instructions of each itype, as a dictionary,
+        or None if it wasn't computed yet.
+        """
+        if not self.itypes_histogram:
+            return None
+        return dict(json.loads(self.itypes_histogram))
+
+    def get_token_counts(self):
+        """
+        Returns the numbers of tokens of each kind in the function's blocks,
+        ordered by kind (see tokens.py): every instruction has an itype, and
+        possibly an immediate, a string and a call. The immediates' count
+        includes zero immediates, which have no tokens.
+        """
+        return (self.num_of_insns, self.num_of_imms, self.num_of_strings,
+                self.num_of_calls)
+
+    def set_digests(self):
+        """
+        Rebuilds the graph's blocks, since the function's strings and calls
+        may have been resolved (and carry the tokens they are stored with)
+        since, and sets the digests and the MinHash signature.
+        """
+        self.graph.refresh_blocks()
+        (self.structure_digest, self.content_digest) = \
+            self.graph.get_digests()
+        self.minhash_signature = minhash.serialize_signature(
+            minhash.get_signature(self.graph.get_data()))
+
     def save(self, *args, **kwargs):
+        resolve_strings_and_calls(self.instructions)
+        self.set_digests()
         super(Function, self).save(*args, **kwargs)
-        self.graph.function = self
-        self.graph.distances = json.dumps(self.graph.distances,
-                                          encoding='ISO-8859-1')
-        self.graph.save()
-        self.executable.save()
-
+        cache.graph_cache.invalidate(self.id)
         for instruction in self.instructions:
             instruction.function = self
-            if instruction.string is not None:
-                instruction.string, _ = String.objects.\
-                    get_or_create(value=instruction.string.value)
-
-            if instruction.call is not None:
-                instruction.call, _ = \
-                    Call.objects.get_or_create(name=instruction.call.name)
+        self.graph.prepare_to_save(self)
+        self.graph.save()
+        self.executable.save()
 
-        chunks = [self.instructions[x:x + 100]
-                  for x in xrange(0, len(self.instructions), 100)]
-        for chunk in chunks:
-            Instruction.objects.bulk_create(chunk)
+        Instruction.objects.bulk_create(self.instructions,
+                                        batch_size=BULK_CREATE_BATCH_SIZE)
 
     def __unicode__(self):
         return self.exe_name + u": " + self.func_name
@@ -112,67 +172,49 @@ class Function(models.Model):
 
 class String(models.Model):
     value = models.TextField(unique=True)
+    # The id of the string's cluster (see tokens.TokenClusters).
+    token = models.BigIntegerField(default=0)
 
     def initialize(self, value):
         self.value = smart_text(value)
 
     def get_data(self):
-        comparable_string = ComparableString(self.value)
-        flexibility = constants.block_similarity.STRING_VALUE_FLEXIBILITY
-        comparable_string.set_flexibility(flexibility)
-        return comparable_string
+        cluster_id = self.token or string_clusters.get_cluster_id(self.value)
+        return tokens.make_token(tokens.STRING_TOKEN, cluster_id)
 
     def __unicode__(self):
         return self.value
 
 
-class ComparableString(unicode):
-        def __hash__(self):
-            return 0
-
-        def __eq__(self, other):
-            return (type(self) == type(other) and
-                    (SM(a=self, b=other).ratio() > self.flexibility))
-
-        def set_flexibility(self, flexibility):
-            self.flexibility = flexibility
-
-
 class Call(models.Model):
     name = models.CharField(max_length=MAX_CALL_NAME_LENGTH,
                             unique=True)
+    # The id of the call's cluster (see tokens.TokenClusters).
+    token = models.BigIntegerField(default=0)
 
     def initialize(self, name):
         self.name = smart_text(name)
 
     def get_data(self):
-        comparable_call = ComparableCall(self.name)
-        flexibility = constants.block_similarity.CALL_NAME_FLEXIBILITY
-        comparable_call.set_flexibility(flexibility)
-        return comparable_call
+        cluster_id = self.token or call_clusters.get_cluster_id(self.name)
+        return tokens.make_token(tokens.CALL_TOKEN, cluster_id)
 
     def __unicode__(self):
         return self.name
 
 
-class ComparableCall(unicode):
-        def __hash__(self):
-            return 0
-
-        def __eq__(self, other):
-            return (type(self) == type(other) and
-                    (SM(a=self, b=other).ratio() > self.flexibility))
-
-        def set_flexibility(self, flexibility):
-            self.flexibility = flexibility
-
-
 class Graph(models.Model):
     edges = models.TextField()
     num_of_blocks = models.PositiveIntegerField()
     num_of_edges = models.PositiveIntegerField()
     block_bounds = models.TextField()
+    # The blocks' distances from the root as a JSON list, -1 for blocks
+    # which are unreachable from it (see graphs.get_root_distances).
     distances = models.TextField()
+    # The max. distance from the root, or -1 if it wasn't computed yet.
+    height = models.IntegerField(default=-1)
+    # The blocks' token sequences, serialized by serialize_blocks().
+    blocks = models.TextField(blank=True, default="")
     function = models.ForeignKey(Function)
 
     def initialize(self, block_bounds, edges, function):
@@ -183,88 +225,140 @@ class Graph(models.Model):
         self.function = function
 
         self.block_bounds = block_bounds
-        self.nx_graph = self._get_nx_graph()
-        self.distances = self._get_distances()
-        self._attach_data_to_nx_graph()
+        self.distances = graphs.get_root_distances(self.num_of_blocks, edges)
+        self.height = max(self.distances)
+        self.function_graph = self._get_function_graph()
 
     def get_data(self):
-        if hasattr(self, "nx_graph"):
-            return self.nx_graph
+        """
+        Returns the graph as a graphs.FunctionGraph.
+        """
+        if hasattr(self, "function_graph"):
+            return self.function_graph
         if self.pk:  # graph is already saved in the db
-            self.nx_graph = self._get_nx_graph()
-            self._attach_data_to_nx_graph()
-        return self.nx_graph
-
-    def _get_nx_graph(self):
-        if self.pk:
             self.edges = json.loads(self.edges)
-        nx_g = nx.DiGraph()
-        # TODO: add list
-        for i in range(self.num_of_blocks):
-            nx_g.add_node(i)
-        for (x, y) in self.edges:
-            nx_g.add_edge(x, y)
-
-        return nx_g
-
-    def _get_distances(self):
-        return nx.single_source_dijkstra_path_length(self.nx_graph, 0)
+            self.block_bounds = json.loads(self.block_bounds)
+            self.distances = self.deserialize_distances(self.distances,
+                                                        self.num_of_blocks)
+            if self.height < 0:
+                self.height = max(self.distances)
+            self.function_graph = self._get_function_graph()
+        return self.function_graph
+
+    @classmethod
+    def get_cached_data(cls, function_id):
+        """
+        Returns the materialized graph of the function with the given id,
+        loading it through the process-wide graph cache.
+        """
+        function_graph = cache.graph_cache.get(function_id)
+        if function_graph is None:
+            graph = cls.objects.select_related('function').\
+                get(function_id=function_id)
+            function_graph = graph.get_data()
+            cache.graph_cache.put(function_id, function_graph,
+                                  function_graph.estimate_size())
+        return function_graph
+
+    @classmethod
+    def deserialize_distances(cls, serialized_distances, num_of_blocks):
+        distances = json.loads(serialized_distances)
+        if isinstance(distances, dict):
+            # Stored as {block id: distance} of the reachable blocks before.
+            distances = [distances.get(str(block_id), -1)
+                         for block_id in range(num_of_blocks)]
+        return distances
+
+    def prepare_to_save(self, function):
+        """
+        Attaches a new graph to its saved function and serializes the data
+        which was computed on initialization.
+        """
+        self.function = function
+        self.distances = json.dumps(self.distances)
+        self.blocks = self.serialize_blocks()
+
+    def refresh_blocks(self):
+        self.function_graph = self._get_function_graph()
+
+    def get_digests(self):
+        """
+        Returns the graph's structure digest, a hash of its edges, and its
+        content digest, a hash of its edges and blocks. Graphs with equal
+        digests have equal structures (or contents), up to hash collisions.
+        """
+        function_graph = self.get_data()
+        structure = [self.num_of_blocks, function_graph.edges()]
+        structure_digest = hashlib.md5(json.dumps(structure)).hexdigest()
+        content = [structure_digest,
+                   [[int(function_graph.dists[i]),
+                     function_graph.get_block_tokens(i)]
+                    for i in range(self.num_of_blocks)]]
+        content_digest = hashlib.md5(json.dumps(content)).hexdigest()
+        return (structure_digest, content_digest)
+
+    def serialize_blocks(self):
+        """
+        Returns the blocks' token sequences as compact JSON.
+        """
+        serialized_blocks = [self.function_graph.get_block_tokens(block_id)
+                             for block_id in range(self.num_of_blocks)]
+        return json.dumps(serialized_blocks, separators=(',', ':'))
+
+    def has_serialized_blocks(self):
+        # Blocks serialized before tokens were interned hold [kind, value]
+        # pairs.
+        return self.blocks and '["' not in self.blocks
+
+    def _get_function_graph(self):
+        blocks = self._get_blocks()
+        try:
+            return graphs.FunctionGraph(self.num_of_blocks, self.edges,
+                                        self.distances, blocks, self.height)
+        except OverflowError:
+            # Blocks serialized before immediates were folded into the
+            # tokens' range (see tokens.make_immediate_token).
+            blocks = [[tokens.fold_token(token) for token in block]
+                      for block in blocks]
+            return graphs.FunctionGraph(self.num_of_blocks, self.edges,
+                                        self.distances, blocks, self.height)
 
     def _get_blocks(self):
+        """
+        Returns the blocks' token sequences.
+        """
         if self.pk:
-            instructions = self.function.instruction_set.all()
-            self.block_bounds = json.loads(self.block_bounds)
-            self.distances = json.loads(self.distances,
-                                        object_hook=utils._decode_dict)
+            if self.has_serialized_blocks():
+                return json.loads(self.blocks)
+            instructions = self.function.instruction_set.\
+                select_related('string', 'call').order_by('offset')
         else:
             instructions = self.function.instructions
 
         ins_data = [instruction.get_data() for instruction in instructions]
         blocks = []
         for block_id in range(self.num_of_blocks):
-            data = {}
             bounds = self.block_bounds[block_id]
             start_offset = bounds[0]
             end_offset = bounds[1] + 1
             ins_data_in_block = ins_data[start_offset:end_offset]
-            if self.pk:
-                block_id = str(block_id)
-            if block_id in self.distances:  # reachable from root
-                data["dist_from_root"] = self.distances[block_id]
-            else:
-                data["dist_from_root"] = -1
-
-            data["block_data"] = []
+
+            block_data = []
             for ins in ins_data_in_block:
-                data["block_data"].append(ins["itype"])
+                block_data.append(ins["itype"])
                 if ins["string"] is not None:
-                    data["block_data"].append(ins["string"])
+                    block_data.append(ins["string"])
                 if ins["call"] is not None:
-                    data["block_data"].append(ins["call"])
+                    block_data.append(ins["call"])
                 if ins["imm"] is not None:
-                    data["block_data"].append(ins["imm"])
-            blocks.append(data)
+                    block_data.append(ins["imm"])
+            blocks.append(block_data)
         return blocks
 
-    def _attach_data_to_nx_graph(self):
-        blocks = self._get_blocks()
-        for i in range(self.num_of_blocks):
-            self.nx_graph.node[i]['data'] = blocks[i]
-
     def __unicode__(self):
         return unicode(self.function) + u"'s graph"
 
 
-class ComparableImmediate(long):
-    def __eq__(self, other):
-        return type(self) == type(other) and long(self) == long(other)
-
-
-class ComparableItype(int):
-    def __eq__(self, other):
-        return type(self) == type(other) and int(self) == int(other)
-
-
 class Instruction(models.Model):
     function = models.ForeignKey(Function)
     itype = models.PositiveSmallIntegerField()
@@ -292,11 +386,11 @@ class Instruction(models.Model):
 
     def get_data(self):
         tmp_data = {}
-        tmp_data["itype"] = ComparableItype(self.itype)
+        tmp_data["itype"] = tokens.make_token(tokens.ITYPE_TOKEN, self.itype)
 
         tmp_data["string"] = self.string.get_data() if self.string else None
         tmp_data["call"] = self.call.get_data() if self.call else None
-        tmp_data["imm"] = (ComparableImmediate(self.immediate) if
+        tmp_data["imm"] = (tokens.make_immediate_token(self.immediate) if
                            self.immediate else None)
         return tmp_data
 
@@ -342,6 +436,7 @@ class Executable(models.Model):
             super(Executable, self).save(*args, **kwargs)
             self.function = self.function
             self.functions.add(self.function)
+        bump_descriptions_version()
 
     def __unicode__(self):
         return self.names
@@ -372,7 +467,260 @@ class Description(models.Model):
                 super(Description, desc).save(*args, **kwargs)
             except Description.DoesNotExist:
                 super(Description, self).save(*args, **kwargs)
+            cache.response_cache.invalidate_function(self.function.id)
+            cache.response_cache.\
+                invalidate_signature(self.function.signature)
+            bump_descriptions_version()
 
     def __unicode__(self):
         return ("function: " + unicode(self.function) +
                 ", user: " + unicode(self.user))
+
+
+class DescriptionsVersion(models.Model):
+    """
+    A single row whose version is bumped, by any process, whenever a
+    description or an executable is written, so that cached responses (see
+    cache.ResponseCache) can be checked against it.
+    """
+    version = models.BigIntegerField(default=0)
+
+
+def get_descriptions_version():
+    versions = DescriptionsVersion.objects.filter(id=1).\
+        values_list('version', flat=True)
+    return versions[0] if versions else 0
+
+
+def bump_descriptions_version():
+    versions = DescriptionsVersion.objects.filter(id=1)
+    if not versions.update(version=models.F('version') + 1):
+        (_, created) = DescriptionsVersion.objects.\
+            get_or_create(id=1, defaults={"version": 1})
+        if not created:  # by another process meanwhile
+            versions.update(version=models.F('version') + 1)
+
+
+#==============================================================================
+# Bulk ingestion
+#==============================================================================
+BULK_CREATE_BATCH_SIZE = 100
+
+
+def bulk_save_functions(functions):
+    """
+    Saves many new functions (built by Function.initialize) along with their
+    graphs, instructions and executables, using one bulk insert per table.
+    Functions whose signature is already stored are not saved again.
+    Returns the stored function for each of the given functions.
+    """
+    signatures = list(set(function.signature for function in functions))
+    stored_functions = dict((function.signature, function) for function in
+                            utils.filter_in_chunks(Function.objects,
+                                                   "signature", signatures))
+    new_functions = []
+    for function in functions:
+        if function.signature not in stored_functions:
+            stored_functions[function.signature] = function
+            new_functions.append(function)
+
+    resolve_strings_and_calls([instruction for function in new_functions
+                               for instruction in function.instructions])
+    for function in new_functions:
+        function.set_digests()
+    Function.objects.bulk_create(new_functions,
+                                 batch_size=BULK_CREATE_BATCH_SIZE)
+    # bulk_create doesn't set the primary keys of the new rows.
+    new_ids = dict(utils.filter_in_chunks(Function.objects.
+                                          values_list("signature", "id"),
+                                          "signature",
+                                          [function.signature for function
+                                           in new_functions]))
+    for function in new_functions:
+        function.id = new_ids[function.signature]
+
+    instructions = []
+    for function in new_functions:
+        for instruction in function.instructions:
+            instruction.function = function
+            instructions.append(instruction)
+    graphs = []
+    for function in new_functions:
+        function.graph.prepare_to_save(function)
+        graphs.append(function.graph)
+    Graph.objects.bulk_create(graphs, batch_size=BULK_CREATE_BATCH_SIZE)
+    Instruction.objects.bulk_create(instructions,
+                                    batch_size=BULK_CREATE_BATCH_SIZE)
+    bulk_save_executables([function.executable for function
+                           in new_functions])
+
+    return [stored_functions[function.signature] for function in functions]
+
+
+def resolve_strings_and_calls(instructions):
+    """
+    Points the instructions' strings and calls to stored String and Call
+    rows, creating the missing rows in bulk.
+    """
+    strings = bulk_get_or_create(String, "value",
+                                 set(instruction.string.value for
+                                     instruction in instructions
+                                     if instruction.string is not None),
+                                 cache.string_id_cache, string_clusters)
+    calls = bulk_get_or_create(Call, "name",
+                               set(instruction.call.name for
+                                   instruction in instructions
+                                   if instruction.call is not None),
+                               cache.call_id_cache, call_clusters)
+    for instruction in instructions:
+        if instruction.string is not None:
+            instruction.string = strings[instruction.string.value]
+        if instruction.call is not None:
+            instruction.call = calls[instruction.call.name]
+
+
+def bulk_get_or_create(model, field, values, id_cache, clusters):
+    """
+    Returns a dictionary mapping each of the values to the model instance
+    whose field has this value. Missing instances are created in bulk, and
+    join their clusters; values which another process creates concurrently
+    are queried instead. id_cache maps recently seen values to their
+    instances' ids and tokens, and saves querying for them.
+    """
+    instances = {}
+    uncached_values = []
+    for value in values:
+        cached = id_cache.get(value)
+        if cached is None:
+            uncached_values.append(value)
+        else:
+            (instance_id, token) = cached
+            instances[value] = model(**{"id": instance_id, field: value,
+                                        "token": token})
+
+    for instance in utils.filter_in_chunks(model.objects, field,
+                                           uncached_values):
+        instances[getattr(instance, field)] = instance
+    missing_values = [value for value in uncached_values
+                      if value not in instances]
+    while missing_values:
+        clusters.sync(force=True)
+        sid = transaction.savepoint()
+        try:
+            model.objects.\
+                bulk_create([model(**{field: value,
+                                      "token": clusters.
+                                      get_cluster_id(value, add=True)})
+                             for value in missing_values],
+                            batch_size=BULK_CREATE_BATCH_SIZE)
+            transaction.savepoint_commit(sid)
+            break
+        except IntegrityError:
+            # Another process stored some of the values meanwhile. Their
+            # tokens are the ones it assigned, so reload the clusters too.
+            transaction.savepoint_rollback(sid)
+            clusters.reset()
+            num_of_missing_values = len(missing_values)
+            for instance in utils.filter_in_chunks(model.objects, field,
+                                                   missing_values):
+                instances[getattr(instance, field)] = instance
+            missing_values = [value for value in missing_values
+                              if value not in instances]
+            if len(missing_values) == num_of_missing_values:
+                raise
+    for instance in utils.filter_in_chunks(model.objects, field,
+                                           missing_values):
+        instances[getattr(instance, field)] = instance
+
+    for value in uncached_values:
+        id_cache.put(value, (instances[value].id, instances[value].token))
+    return instances
+
+
+def bulk_save_executables(executables):
+    """
+    Saves executables (built by Executable.initialize) and links them to
+    their functions, as Executable.save does, with bulk queries.
+    """
+    stored_executables = \
+        dict((exe.signature, exe) for exe in
+             utils.filter_in_chunks(Executable.objects, "signature",
+                                    list(set(exe.signature
+                                             for exe in executables))))
+    new_executables = []
+    changed_executables = set()
+    for exe in executables:
+        if exe.signature in stored_executables:
+            stored_exe = stored_executables[exe.signature]
+            if exe.exe_name not in stored_exe.names:
+                stored_exe.names += exe.exe_name + ", "
+                if stored_exe.pk:
+                    changed_executables.add(stored_exe)
+        else:
+            exe.names = exe.exe_name
+            stored_executables[exe.signature] = exe
+            new_executables.append(exe)
+
+    Executable.objects.bulk_create(new_executables,
+                                   batch_size=BULK_CREATE_BATCH_SIZE)
+    for exe in utils.filter_in_chunks(Executable.objects, "signature",
+                                      [exe.signature for exe
+                                       in new_executables]):
+        stored_executables[exe.signature].id = exe.id
+    for exe in changed_executables:
+        super(Executable, exe).save()
+
+    links = [Executable.functions.through(
+                executable_id=stored_executables[exe.signature].id,
+                function_id=exe.function.id)
+             for exe in executables]
+    Executable.functions.through.objects.\
+        bulk_create(links, batch_size=BULK_CREATE_BATCH_SIZE)
+    if links or changed_executables:
+        bump_descriptions_version()
+
+
+def bulk_save_descriptions(descriptions):
+    """
+    Saves descriptions (built by Description.initialize) as Description.save
+    does, with bulk queries.
+    """
+    function_ids = list(set(desc.function.id for desc in descriptions))
+    stored_descriptions = {}
+    for desc in utils.filter_in_chunks(Description.objects, "function_id",
+                                       function_ids):
+        stored_descriptions.setdefault(desc.function_id, []).append(desc)
+
+    new_descriptions = []
+    changed_functions = set()
+    for desc in descriptions:
+        function_descriptions = \
+            stored_descriptions.setdefault(desc.function.id, [])
+        if any(stored_desc.data == desc.data
+               for stored_desc in function_descriptions):
+            continue
+        user_descriptions = [stored_desc for stored_desc
+                             in function_descriptions
+                             if stored_desc.user_id == desc.user.id]
+        if user_descriptions:
+            user_descriptions[0].data = desc.data
+            if user_descriptions[0].pk:
+                super(Description, user_descriptions[0]).save()
+        else:
+            new_descriptions.append(desc)
+            function_descriptions.append(desc)
+        changed_functions.add(desc.function)
+
+    Description.objects.bulk_create(new_descriptions,
+                                    batch_size=BULK_CREATE_BATCH_SIZE)
+    for function in changed_functions:
+        cache.response_cache.invalidate_function(function.id)
+        cache.response_cache.invalidate_signature(function.signature)
+    if changed_functions:
+        bump_descriptions_version()
+
+
+string_clusters = tokens.TokenClusters(
+    String, "value", constants.block_similarity.STRING_VALUE_FLEXIBILITY)
+call_clusters = tokens.TokenClusters(
+    Call, "name", constants.block_similarity.CALL_NAME_FLEXIBILITY)
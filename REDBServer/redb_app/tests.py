@@ -0,0 +1,69 @@
+"""
+Tests of the server's query handlers.
+"""
+
+# standard library imports
+import json
+
+# related third party imports
+from django.contrib.auth.models import User
+from django.test import TestCase
+
+# local application/library specific imports
+import cache
+import constants
+
+
+def get_attributes(func_signature):
+    """
+    Returns the attributes of a small function with two blocks.
+    """
+    return {"func_signature": func_signature,
+            "func_name": "func_" + func_signature,
+            "frame_attributes": {"args_size": 8, "vars_size": 16,
+                                 "regs_size": 4, "frame_size": 28},
+            "itypes": [1, 2, 3, 4, 5, 6],
+            "strings": {"1": "hello"},
+            "immediates": {"2": 7},
+            "calls": {"4": "printf"},
+            "exe_signature": "exe_" + func_signature,
+            "exe_name": "exe_" + func_signature,
+            "graph": {"block_bounds": [[0, 2], [3, 5]],
+                      "edges": [[0, 1]]}}
+
+
+class TopKRequestTest(TestCase):
+    def setUp(self):
+        User.objects.create_user("user", password="password")
+        self.client.login(username="user", password="password")
+        self.skip_fuzzy_matching = constants.exact_match.SKIP_FUZZY_MATCHING
+        constants.exact_match.SKIP_FUZZY_MATCHING = False
+        cache.response_cache.clear()
+
+    def tearDown(self):
+        constants.exact_match.SKIP_FUZZY_MATCHING = self.skip_fuzzy_matching
+        cache.response_cache.clear()
+
+    def submit(self, func_signature):
+        response = self.client.post(
+            "/", {"type": json.dumps("submit"),
+                  "attributes": json.dumps(get_attributes(func_signature)),
+                  "description": json.dumps({"name": func_signature})})
+        self.assertEqual(json.loads(response.content), "SUCCESS")
+
+    def request(self, func_signature, top_k):
+        response = self.client.post(
+            "/", {"type": json.dumps("request"),
+                  "attributes": json.dumps(get_attributes(func_signature)),
+                  "top_k": json.dumps(top_k)})
+        return json.loads(response.content)
+
+    def test_exact_match_counts_against_top_k(self):
+        # An identical function with another signature is a perfect fuzzy
+        # match.
+        self.submit("a")
+        self.submit("b")
+        descriptions = self.request("a", 1)
+        self.assertEqual(len(descriptions), 1)
+        self.assertEqual(descriptions[0]["data"], {"name": "a"})
+        self.assertEqual(len(self.request("a", 2)), 2)
@@ -0,0 +1,223 @@
+"""
+Integer tokens representing the contents of a block.
+
+Every instruction contributes its itype, and possibly an immediate, a string
+and a call, to its block's token sequence. Strings and call names are
+interned into clusters of similar values, so that block comparison runs on
+plain integers while still treating similar strings and calls as equal.
+"""
+
+# standard library imports
+from difflib import SequenceMatcher
+import hashlib
+import threading
+import time
+
+import constants
+import utils
+
+# The two low bits of a token hold its kind.
+ITYPE_TOKEN = 0
+IMMEDIATE_TOKEN = 1
+STRING_TOKEN = 2
+CALL_TOKEN = 3
+TOKEN_KIND_BITS = 2
+
+VALUE_HASH_BITS = 48
+
+# TokenClusters compares values which share a character n-gram.
+NGRAM_SIZE = 3
+NGRAM_PADDING = "\0"
+
+
+# Tokens are kept in int64 arrays (see graphs.FunctionGraph), which bounds
+# their values.
+MAX_TOKEN_VALUE = 1 << (63 - TOKEN_KIND_BITS)
+
+
+def make_token(kind, value):
+    return (value << TOKEN_KIND_BITS) | kind
+
+
+def make_immediate_token(immediate):
+    """
+    Immediates out of the tokens' range (e.g. 64-bit addresses) are folded
+    into it by hashing them.
+    """
+    if not -MAX_TOKEN_VALUE <= immediate < MAX_TOKEN_VALUE:
+        immediate = value_hash(str(immediate))
+    return make_token(IMMEDIATE_TOKEN, immediate)
+
+
+def fold_token(token):
+    """
+    Returns the token an immediate's unfolded token (as serialized before
+    immediates were folded) is folded into. Other tokens are returned as is.
+    """
+    if get_token_kind(token) != IMMEDIATE_TOKEN:
+        return token
+    return make_immediate_token(token >> TOKEN_KIND_BITS)
+
+
+def get_token_kind(token):
+    return token & ((1 << TOKEN_KIND_BITS) - 1)
+
+
+def value_hash(value):
+    """
+    A stable hash of a string or call name, used as the id of the cluster
+    the value represents.
+    """
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return int(hashlib.md5(value).hexdigest()[:VALUE_HASH_BITS / 4], 16)
+
+
+class TokenClusters:
+    """
+    Clusters the values of a model's field (String values or Call names):
+    a value joins the cluster of the first representative it is similar to
+    (by SequenceMatcher ratio, in order of length and then of cluster id),
+    or else becomes the representative of a new cluster. A cluster's id is its
+    representative's value_hash, and is stored on the model's rows as their
+    'token'.
+
+    The representatives are indexed by their character n-grams, and a value
+    is only compared to the representatives it shares an n-gram with.
+
+    The clusters are loaded from the DB and kept in sync incrementally (and
+    every FULL_SYNC_INTERVAL, with the values committed out of id order), so
+    every process assigns the same ids.
+    """
+    def __init__(self, model, field, flexibility):
+        self.model = model
+        self.field = field
+        self.flexibility = flexibility
+
+        self._cluster_ids = {}  # value -> cluster id
+        self._representatives = []  # (value, cluster id), in addition order
+        self._ngram_index = {}  # n-gram -> indexes of representatives
+        self._row_ids = set()  # the ids of the loaded rows
+        self._max_id = 0
+        self._last_sync = 0
+        self._last_full_sync = 0
+        self._lock = threading.RLock()
+
+    def sync(self, force=False):
+        """
+        Loads the values stored since the last sync, and every
+        FULL_SYNC_INTERVAL also the stored values which weren't loaded (i.e.
+        committed out of id order). Unless forced, syncs at most once per
+        SYNC_INTERVAL.
+        """
+        with self._lock:
+            now = time.time()
+            if (not force and
+                    now - self._last_sync <
+                    constants.token_clusters.SYNC_INTERVAL):
+                return
+            self._last_sync = now
+            fields = ['id', self.field, 'token']
+            clustered_rows = self.model.objects.exclude(token=0)
+            rows = list(clustered_rows.filter(id__gt=self._max_id).
+                        order_by('id').values_list(*fields))
+            if self._max_id == 0:  # loaded all the stored values
+                self._last_full_sync = now
+            elif (now - self._last_full_sync >=
+                    constants.cache.FULL_SYNC_INTERVAL):
+                self._last_full_sync = now
+                missing_ids = \
+                    set(clustered_rows.values_list('id', flat=True)) - \
+                    self._row_ids - set(row[0] for row in rows)
+                for chunk in utils.chunks(sorted(missing_ids),
+                                          utils.MAX_IN_QUERY_SIZE):
+                    rows += clustered_rows.filter(id__in=chunk).\
+                        order_by('id').values_list(*fields)
+            for (row_id, value, cluster_id) in rows:
+                self._add(value, cluster_id)
+                self._row_ids.add(row_id)
+                self._max_id = max(self._max_id, row_id)
+
+    def reset(self):
+        """
+        Drops the loaded clusters, along with the values added to them, so
+        that the next sync reloads them from the DB. Used when the rows of
+        added values were rolled back.
+        """
+        with self._lock:
+            self._cluster_ids = {}
+            self._representatives = []
+            self._ngram_index = {}
+            self._row_ids = set()
+            self._max_id = 0
+            self._last_sync = 0
+            self._last_full_sync = 0
+
+    def get_cluster_id(self, value, add=False):
+        """
+        Returns the id of the cluster the value belongs to. If add is set,
+        a value which is not stored yet joins its cluster (or becomes a new
+        representative), affecting the following calls.
+        """
+        self.sync()
+        with self._lock:
+            cluster_id = self._cluster_ids.get(value)
+            if cluster_id is not None:
+                return cluster_id
+            cluster_id = self._find_similar(value)
+            if cluster_id is None:
+                cluster_id = value_hash(value)
+            if add:
+                self._add(value, cluster_id)
+            return cluster_id
+
+    def _add(self, value, cluster_id):
+        if self._cluster_ids.get(value) == cluster_id:  # added before stored
+            return
+        self._cluster_ids[value] = cluster_id
+        if cluster_id == value_hash(value):  # a representative
+            index = len(self._representatives)
+            self._representatives.append((value, cluster_id))
+            for ngram in get_ngrams(value):
+                self._ngram_index.setdefault(ngram, []).append(index)
+
+    def _find_similar(self, value):
+        flexibility = self.flexibility
+        length = len(value)
+        # ratio() <= 2 * min(len_a, len_b) / (len_a + len_b), which bounds
+        # the lengths of the representatives worth checking.
+        min_length = length * flexibility / (2 - flexibility)
+        max_length = length * (2 - flexibility) / flexibility
+
+        indexes = set()
+        for ngram in get_ngrams(value):
+            indexes.update(self._ngram_index.get(ngram, ()))
+        candidates = []
+        for index in indexes:
+            (representative, cluster_id) = self._representatives[index]
+            if min_length <= len(representative) <= max_length:
+                candidates.append((len(representative), cluster_id, index))
+        # Unlike the order of addition, this order is the same in every
+        # process.
+        candidates.sort()
+
+        matcher = SequenceMatcher(b=value)
+        for (_, _, index) in candidates:
+            (representative, cluster_id) = self._representatives[index]
+            matcher.set_seq1(representative)
+            if (matcher.real_quick_ratio() > flexibility and
+                    matcher.quick_ratio() > flexibility and
+                    matcher.ratio() > flexibility):
+                return cluster_id
+        return None
+
+
+def get_ngrams(value):
+    """
+    Returns the distinct character n-grams of a value, padded so that values
+    shorter than NGRAM_SIZE have n-grams too.
+    """
+    padding = NGRAM_PADDING * (NGRAM_SIZE - 1)
+    value = padding + value + padding
+    return set(value[start:start + NGRAM_SIZE]
+               for start in xrange(len(value) - NGRAM_SIZE + 1))
@@ -5,8 +5,11 @@ import os
 from ctypes import cdll
 import time
 import ctypes
+import numpy as np
 from django.http import HttpResponse
 from django.contrib.auth import authenticate, login
+from django.db import connection, transaction
+from django.core.management.color import no_style
 import base64
 
 
@@ -41,18 +44,147 @@ def _decode_dict(data):
     return rv
 
 
+#==============================================================================
+# Query utilities
+#==============================================================================
+# Stay well below SQLite's limit of 999 parameters per query.
+MAX_IN_QUERY_SIZE = 500
+
+
+def chunks(items, chunk_size):
+    for start in xrange(0, len(items), chunk_size):
+        yield items[start:start + chunk_size]
+
+
+def filter_in_chunks(queryset, field, values):
+    """
+    Yields the objects of queryset whose field is in values, querying for a
+    chunk of values at a time.
+    """
+    for chunk in chunks(values, MAX_IN_QUERY_SIZE):
+        for obj in queryset.filter(**{field + "__in": chunk}):
+            yield obj
+
+
+#==============================================================================
+# DB schema utilities
+#==============================================================================
+def add_missing_columns(model):
+    """
+    Adds to the model's table the columns of fields which were added to the
+    model after the table was created (syncdb only creates missing tables).
+    Returns the names of the added columns.
+    """
+    cursor = connection.cursor()
+    table = model._meta.db_table
+    existing_columns = [column[0] for column in connection.introspection.
+                        get_table_description(cursor, table)]
+    quote_name = connection.ops.quote_name
+
+    added_columns = []
+    for field in model._meta.local_fields:
+        if field.column in existing_columns:
+            continue
+        sql = "ALTER TABLE %s ADD COLUMN %s %s" % \
+            (quote_name(table), quote_name(field.column),
+             field.db_type(connection=connection))
+        if field.null:
+            sql += " NULL"
+        else:
+            sql += " NOT NULL DEFAULT " + _sql_literal(field.get_default())
+        cursor.execute(sql)
+        added_columns.append(field.column)
+    transaction.commit_unless_managed()
+    return added_columns
+
+
+def create_missing_indexes(model):
+    """
+    Creates the model's indexes (including index_together) which don't
+    exist yet.
+    """
+    cursor = connection.cursor()
+    for sql in connection.creation.sql_indexes_for_model(model, no_style()):
+        cursor.execute(sql.replace("CREATE INDEX",
+                                   "CREATE INDEX IF NOT EXISTS", 1))
+    transaction.commit_unless_managed()
+
+
+def _sql_literal(value):
+    if isinstance(value, basestring):
+        return "'" + value.replace("'", "''") + "'"
+    return str(value)
+
+
 #==============================================================================
 # Control-Flow Graph-related utilities
 #==============================================================================
-class CliquerGraph:
-    DLL_DIR_PATH = os.path.dirname(__file__)
-    DLL_FILE_PATH = os.path.join(DLL_DIR_PATH, 'CliquerReduced')
+CLIQUER_DLL_FILE_PATH = os.path.join(os.path.dirname(__file__),
+                                     'CliquerReduced')
+
+# (name, argtypes, restype) of the Cliquer library functions in use.
+CLIQUER_FUNCTIONS = [
+    ("graph_new", [ctypes.c_int], ctypes.c_void_p),
+    ("graph_free", [ctypes.c_void_p], None),
+    ("graph_print", [ctypes.c_void_p], None),
+    ("graph_edge_count", [ctypes.c_void_p], ctypes.c_int),
+    ("graph_add_edge_redb", [ctypes.c_void_p, ctypes.c_int, ctypes.c_int],
+     ctypes.c_int),
+    ("graph_add_edges_redb", [ctypes.c_void_p, ctypes.POINTER(ctypes.c_int),
+                              ctypes.c_int], ctypes.c_int),
+    ("graph_set_vertex_weight_redb",
+     [ctypes.c_void_p, ctypes.c_int, ctypes.c_int], ctypes.c_int),
+    ("graph_set_vertex_weights_redb",
+     [ctypes.c_void_p, ctypes.POINTER(ctypes.c_int)], ctypes.c_int),
+    ("clique_options_new_redb", [ctypes.c_void_p], ctypes.c_void_p),
+    ("get_max_clique_redb", [ctypes.c_void_p, ctypes.c_void_p],
+     ctypes.POINTER(ctypes.c_int)),
+    ("get_max_clique_bounded_redb",
+     [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_long, ctypes.c_double,
+      ctypes.POINTER(ctypes.c_int)], ctypes.POINTER(ctypes.c_int)),
+    ("free_redb", [ctypes.c_void_p], None)]
+
+_cliquer_lib = None
+
+
+def get_cliquer_lib():
+    """
+    Returns the Cliquer library, which is loaded (and has its functions'
+    signatures declared) on first use.
+    """
+    global _cliquer_lib
+    if _cliquer_lib is None:
+        lib = cdll.LoadLibrary(CLIQUER_DLL_FILE_PATH)
+        for (name, argtypes, restype) in CLIQUER_FUNCTIONS:
+            function = getattr(lib, name)
+            function.argtypes = argtypes
+            function.restype = restype
+        _cliquer_lib = lib
+    return _cliquer_lib
+
+
+def _as_int_array(values):
+    values = np.ascontiguousarray(values, dtype=np.intc)
+    return (values, values.ctypes.data_as(ctypes.POINTER(ctypes.c_int)))
 
+
+class CliquerGraph:
+    """
+    A Cliquer graph. Use it as a context manager (or call free()) to
+    release it.
+    """
     def __init__(self, n):
         """ n : number of vertices """
-        self.lib = cdll.LoadLibrary(CliquerGraph.DLL_FILE_PATH)
+        self.lib = get_cliquer_lib()
+        self.n = n
         self.g = self.lib.graph_new(n)
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.free()
+
     def add_edge(self, i, j):
         """
         i, j : vertices in [0..n-1]
@@ -60,12 +192,13 @@ class CliquerGraph:
         """
         return self.lib.graph_add_edge_redb(self.g, i, j)
 
-    def remove_edge(self, i, j):
+    def add_edges(self, edges):
         """
-        i, j : vertices in [0..n-1]
+        edges : (i, j) pairs of vertices in [0..n-1], e.g. a k x 2 array
         returns: 0 on success, -1 on failure
         """
-        return self.lib.graph_remove_edge_redb(self.g, i, j)
+        (edges, edges_ptr) = _as_int_array(edges)
+        return self.lib.graph_add_edges_redb(self.g, edges_ptr, len(edges))
 
     def set_vertex_weight(self, i, w):
         """
@@ -75,35 +208,64 @@ class CliquerGraph:
         """
         return self.lib.graph_set_vertex_weight_redb(self.g, i, w)
 
+    def set_vertex_weights(self, weights):
+        """
+        weights : the n vertices' weights (of type int in c)
+        returns: 0 on success, -1 on failure
+        """
+        if len(weights) != self.n:
+            return -1
+        (weights, weights_ptr) = _as_int_array(weights)
+        return self.lib.graph_set_vertex_weights_redb(self.g, weights_ptr)
+
     def get_maximum_clique(self, reorder=0):
         """
         reorder =
             0(no reordering)/"reorder_by_greedy_coloring"/"reorder_by_degree"
-        returns: max_size on success, -1 on failure
+        returns: the clique's vertices on success, -1 on failure
+        """
+        result = self.find_maximum_clique(reorder)
+        if result == -1:
+            return -1
+        return result[0]
+
+    def find_maximum_clique(self, reorder=0, node_limit=0, time_limit=0):
+        """
+        reorder : as in get_maximum_clique
+        node_limit : max. number of search nodes to visit (0 = unlimited)
+        time_limit : max. processor time to search, in seconds (0 = no limit)
+        returns: (clique, is_optimal) on success, -1 on failure. Once a limit
+            is reached, clique is the heaviest clique found so far, and
+            is_optimal is False.
         """
         if reorder not in [0, "reorder_by_greedy_coloring",
                            "reorder_by_degree"]:
             return -1
         if reorder:
             reorder = getattr(self.lib, reorder)
+        else:
+            reorder = None
 
+        optimal = ctypes.c_int(1)
         opts = self.lib.clique_options_new_redb(reorder)
-        int_ptr = self.lib.get_max_clique_redb(self.g, opts)
-
-        int_ptr = ctypes.cast(int_ptr, ctypes.POINTER(ctypes.c_int))
-
         try:
-            clique_size = int_ptr[0]
-        except:
-            return []
-        clique = [int_ptr[i] for i in range(1, 1 + clique_size)]
-
-        self.lib.free_redb(int_ptr)
-        self.lib.free_redb(opts)
-        return clique
+            int_ptr = self.lib.get_max_clique_bounded_redb(
+                self.g, opts, node_limit, time_limit, ctypes.byref(optimal))
+            if not int_ptr:  # search failed
+                return ([], False)
+            try:
+                clique_size = int_ptr[0]
+                return ([int_ptr[i] for i in range(1, 1 + clique_size)],
+                        bool(optimal.value))
+            finally:
+                self.lib.free_redb(int_ptr)
+        finally:
+            self.lib.free_redb(opts)
 
     def free(self):
-        self.lib.graph_free(self.g)
+        if self.g is not None:
+            self.lib.graph_free(self.g)
+            self.g = None
 
     def edge_count(self):
         return self.lib.graph_edge_count(self.g)
@@ -112,6 +274,96 @@ class CliquerGraph:
         return str(self.lib.graph_print(self.g))
 
 
+def approximate_maximum_weight_clique(adjacency, weights, num_of_starts,
+                                     max_num_of_swaps):
+    """
+    Finds a heavy clique, with no guarantee that it is the heaviest, in
+    polynomial time.
+    adjacency : a symmetric k x k boolean matrix, with a False diagonal
+    weights : the k vertices' non-negative weights
+    num_of_starts : number of vertices (of the highest potential) to start
+        searching from
+    max_num_of_swaps : max. number of local search moves per start
+    returns: the clique's vertices
+
+    Each search greedily grows a clique, adding the candidate of the highest
+    potential (its weight plus its neighbours' weights), then swaps a member
+    out for a heavier vertex it is the only non-neighbour of, and grows
+    again, as long as that improves the clique.
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    if len(weights) == 0:
+        return []
+    potentials = weights + adjacency.dot(weights)
+    best_clique = []
+    best_weight = -1.0
+    for start in np.argsort(-potentials, kind='mergesort')[:num_of_starts]:
+        clique = _CliqueSearch(adjacency, weights, potentials)
+        clique.add(start)
+        clique.grow()
+        for _ in xrange(max_num_of_swaps):
+            if not clique.swap():
+                break
+            clique.grow()
+        if clique.weight() > best_weight:
+            best_clique = [int(v) for v in clique.members()]
+            best_weight = clique.weight()
+    return best_clique
+
+
+class _CliqueSearch:
+    def __init__(self, adjacency, weights, potentials):
+        self.adjacency = adjacency
+        self.weights = weights
+        self.potentials = potentials
+        self.in_clique = np.zeros(len(weights), dtype=bool)
+        # The number of members each vertex is not adjacent to (itself
+        # excluded).
+        self.misses = np.zeros(len(weights), dtype=np.intp)
+
+    def add(self, v):
+        self.in_clique[v] = True
+        self.misses += ~self.adjacency[v]
+        self.misses[v] -= 1
+
+    def remove(self, v):
+        self.in_clique[v] = False
+        self.misses -= ~self.adjacency[v]
+        self.misses[v] += 1
+
+    def grow(self):
+        while True:
+            candidates = (self.misses == 0) & ~self.in_clique
+            if not candidates.any():
+                return
+            self.add(np.argmax(np.where(candidates, self.potentials,
+                                        -np.inf)))
+
+    def swap(self):
+        """
+        Makes the most improving swap. Returns False if there's none.
+        """
+        candidates = np.flatnonzero((self.misses == 1) & ~self.in_clique)
+        if len(candidates) == 0:
+            return False
+        members = self.members()
+        blockers = members[np.argmax(
+            ~self.adjacency[np.ix_(candidates, members)], axis=1)]
+        gains = self.weights[candidates] - self.weights[blockers]
+        best = np.argmax(gains)
+        if gains[best] <= 0:
+            return False
+        self.remove(blockers[best])
+        self.add(candidates[best])
+        return True
+
+    def members(self):
+        return np.flatnonzero(self.in_clique)
+
+    def weight(self):
+        return self.weights[self.in_clique].sum()
+
+
 ##############################################################################
 def view_or_basicauth(view, request, test_func, realm="", *args, **kwargs):
     """
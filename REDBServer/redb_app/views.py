@@ -12,6 +12,7 @@ from django.http import HttpResponse
 
 # local application/library specific imports
 import actions
+import cache
 from redb_app.utils import logged_in_or_basicauth
 from django.http.response import HttpResponseBadRequest
 
@@ -34,6 +35,12 @@ def general_handler(request):
             return request_handler(request)
         elif query_type == "submit":
             return submit_handler(request)
+        elif query_type == "batch_request":
+            return batch_request_handler(request)
+        elif query_type == "batch_submit":
+            return batch_submit_handler(request)
+        elif query_type == "cache_stats":
+            return cache_stats_handler(request)
     except Exception as e:
         logger.error(str(e))
         return HttpResponseBadRequest()
@@ -45,12 +52,26 @@ def request_handler(request):
     """
     request_action = actions.RequestAction(request)
     request_action.process_attributes()
-    request_action.temp_function()
-    request_action.db_filtering()
-    # TODO: Commented out until fixed
-    #request_action.dictionary_filtering()
-    request_action.matching_grade_filtering()
-    descriptions = request_action.get_descriptions()
+    descriptions = request_action.cached_descriptions()
+    if descriptions is None:
+        request_action.temp_function()
+        request_action.exact_match_filtering()
+        if request_action.fuzzy_matching_required():
+            request_action.db_filtering()
+            request_action.matching_grade_filtering()
+        descriptions = request_action.get_descriptions()
+        request_action.cache_descriptions(descriptions)
+    return HttpResponse(json.dumps(descriptions))
+
+
+def batch_request_handler(request):
+    """
+    Handles a Request for the descriptions of many functions. Returns a list
+    of descriptions lists, in the order of the requested functions.
+    """
+    batch_request_action = actions.BatchRequestAction(request)
+    batch_request_action.process_attributes()
+    descriptions = batch_request_action.get_descriptions()
     return HttpResponse(json.dumps(descriptions))
 
 
@@ -65,3 +86,27 @@ def submit_handler(request):
     submit_action.process_description()
     submit_action.insert_description()
     return HttpResponse(json.dumps("SUCCESS"))
+
+
+def batch_submit_handler(request):
+    """
+    Handles many submitted descriptions at once.
+    """
+    batch_submit_action = actions.BatchSubmitAction(request)
+    if not batch_submit_action.process_attributes():
+        return HttpResponse(json.dumps("Unable to submit only Thunks"))
+    batch_submit_action.temp_functions()
+    batch_submit_action.process_descriptions()
+    batch_submit_action.insert_descriptions()
+    return HttpResponse(json.dumps("SUCCESS"))
+
+
+def cache_stats_handler(request):
+    """
+    Reports the usage of this server process' caches, and the candidates
+    each stage of its scoring cascade has handled.
+    """
+    stats = {"graph_cache": cache.graph_cache.stats(),
+             "response_cache": cache.response_cache.stats(),
+             "scoring_cascade": actions.cascade_stats.stats()}
+    return HttpResponse(json.dumps(stats))